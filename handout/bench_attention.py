@@ -0,0 +1,104 @@
+"""
+Times a single attention layer (forward + backward) for every combination of n_kv_head and attention
+backend at a fixed n_query_head, so MHA (n_kv_head == n_query_head), GQA and MQA (n_kv_head == 1) can
+be compared directly. With kv_schedule set, a GPT with one layer per entry is built instead and every
+layer is reported with its key/value head count, parameters, KV cache bytes and time. Examples:
+
+python bench_attention.py --seq_len=512 --kv_heads=[6,2,1] --attn_impls=['einsum','sdpa']
+python bench_attention.py --kv_schedule=[6,6,3,3,1,1]
+"""
+
+import sys
+import time
+
+import torch
+
+from mingpt.model import GPT, CausalSelfAttention, GroupedQueryAttention
+from mingpt.utils import set_seed, CfgNode as CN
+
+# -----------------------------------------------------------------------------
+
+def get_config():
+
+    C = CN()
+    C.seed = 3407
+    C.device = 'cpu'
+    C.batch_size = 16
+    C.seq_len = 256
+    C.n_embd = 192
+    C.n_query_head = 6
+    C.kv_heads = [6, 3, 2, 1]
+    C.kv_schedule = None # per-layer n_kv_head of a whole model, e.g. [6, 6, 3, 3, 1, 1]
+    C.attn_impls = ['einsum', 'sdpa', 'tiled']
+    C.rope = True
+    C.window_size = None # sliding-window attention over the last window_size positions
+    C.backward = True
+    C.warmup = 2
+    C.iters = 5
+    return C
+
+def build_model_config(config, n_kv_head, attn_impl):
+    model_config = GPT.get_default_config()
+    model_config.n_embd = config.n_embd
+    model_config.n_query_head = config.n_query_head
+    model_config.n_kv_head = n_kv_head
+    model_config.block_size = config.seq_len
+    model_config.rope = config.rope
+    model_config.attn_impl = attn_impl
+    model_config.window_size = config.window_size
+    model_config.attn_pdrop = 0.0
+    model_config.resid_pdrop = 0.0
+    model_config.embd_pdrop = 0.0
+    return model_config
+
+def build_attention(config, n_kv_head, attn_impl):
+    model_config = build_model_config(config, n_kv_head, attn_impl)
+    if n_kv_head == config.n_query_head:
+        return CausalSelfAttention(model_config)
+    return GroupedQueryAttention(model_config)
+
+def time_attention(attn, x, config):
+    def step():
+        y, _ = attn(x)
+        if config.backward:
+            y.sum().backward()
+    for _ in range(config.warmup):
+        step()
+    # report the median, a single core is easily disturbed by other processes
+    times = []
+    for _ in range(config.iters):
+        start = time.time()
+        step()
+        times.append(time.time() - start)
+    return sorted(times)[len(times) // 2]
+
+# -----------------------------------------------------------------------------
+
+if __name__ == '__main__':
+
+    config = get_config()
+    config.merge_from_args(sys.argv[1:])
+    set_seed(config.seed)
+
+    x = torch.randn(config.batch_size, config.seq_len, config.n_embd, device=config.device,
+                    requires_grad=config.backward)
+    print("b=%d t=%d n_embd=%d n_query_head=%d %s" % (config.batch_size, config.seq_len, config.n_embd,
+          config.n_query_head, "forward+backward" if config.backward else "forward"))
+    if config.kv_schedule is not None:
+        for attn_impl in config.attn_impls:
+            model_config = build_model_config(config, config.kv_schedule, attn_impl)
+            model_config.n_layer = len(config.kv_schedule)
+            model_config.vocab_size = 1
+            model = GPT(model_config).to(config.device)
+            for stats, block in zip(model.layer_stats(), model.transformer.h):
+                with torch.set_grad_enabled(config.backward):
+                    dt = time_attention(block.attn, x, config)
+                print("%-7s layer %-2d n_kv_head=%-2d %8.2fM params %6d kv bytes/token %8.2fms" % (attn_impl,
+                      stats['layer'], stats['n_kv_head'], stats['n_params'] / 1e6, stats['kv_bytes_per_token'], dt * 1000))
+    else:
+        for attn_impl in config.attn_impls:
+            for n_kv_head in config.kv_heads:
+                attn = build_attention(config, n_kv_head, attn_impl).to(config.device)
+                with torch.set_grad_enabled(config.backward):
+                    dt = time_attention(attn, x, config)
+                print("%-7s n_kv_head=%-2d %-21s %8.2fms" % (attn_impl, n_kv_head, type(attn).__name__, dt * 1000))
@@ -0,0 +1,69 @@
+"""
+Replays a stream of generation requests with random prompt and completion lengths, once through
+GPT.generate one request at a time and once through the continuous-batching Engine, and reports
+the throughput of both. Example:
+
+python bench_engine.py --n_requests=64 --engine.max_batch_size=32
+"""
+
+import sys
+import time
+import random
+
+import torch
+
+from mingpt.model import GPT
+from mingpt.engine import Engine
+from mingpt.utils import set_seed, CfgNode as CN
+
+# -----------------------------------------------------------------------------
+
+def get_config():
+
+    C = CN()
+    C.seed = 3407
+    C.device = 'cpu'
+    C.n_requests = 32
+    C.prompt_len = [4, 64] # prompt lengths are drawn uniformly from this range
+    C.max_new_tokens = [16, 64]
+
+    C.model = GPT.get_default_config()
+    C.model.n_layer = 6
+    C.model.n_query_head = 6
+    C.model.n_kv_head = 2
+    C.model.n_embd = 192
+    C.model.vocab_size = 65
+    C.model.block_size = 128
+    C.model.rope = True
+
+    C.engine = Engine.get_default_config()
+    return C
+
+# -----------------------------------------------------------------------------
+
+if __name__ == '__main__':
+
+    config = get_config()
+    config.merge_from_args(sys.argv[1:])
+    set_seed(config.seed)
+
+    model = GPT(config.model).to(config.device).eval()
+    requests = [([random.randrange(config.model.vocab_size) for _ in range(random.randint(*config.prompt_len))],
+                 random.randint(*config.max_new_tokens)) for _ in range(config.n_requests)]
+    n_tokens = sum(max_new_tokens for _, max_new_tokens in requests)
+
+    start = time.time()
+    for prompt, max_new_tokens in requests:
+        idx = torch.tensor([prompt], dtype=torch.long, device=config.device)
+        model.generate(idx, max_new_tokens, config.engine.temperature, config.engine.do_sample, config.engine.top_k, use_cache=True)
+    generate_dt = time.time() - start
+    print("generate per request: %6.2fs, %8.1f tokens/s" % (generate_dt, n_tokens / generate_dt))
+
+    engine = Engine(config.engine, model)
+    for prompt, max_new_tokens in requests:
+        engine.add_request(prompt, max_new_tokens)
+    start = time.time()
+    engine.run()
+    engine_dt = time.time() - start
+    print("engine:               %6.2fs, %8.1f tokens/s in %d steps, %.1fx" % (engine_dt, n_tokens / engine_dt,
+          engine.n_steps, generate_dt / engine_dt))
@@ -0,0 +1,109 @@
+"""
+Compares plain cached generation of a character-level model with speculative decoding, where a small
+draft model proposes n_draft tokens per round that the target verifies in one forward. Target and draft
+are loaded from folders written by chargpt.py, or, when a folder is not given, trained from scratch for
+trainer.max_iters iterations on input_file first. Examples:
+
+python bench_speculative.py --target_folder="'out/vanilla'" --draft_folder="'out/draft'"
+python bench_speculative.py --trainer.max_iters=500 --n_drafts=[2,4,8] --do_sample=True
+"""
+
+import os
+import sys
+import json
+import time
+
+import torch
+
+from mingpt.model import GPT
+from mingpt.trainer import Trainer
+from mingpt.utils import set_seed, CfgNode as CN
+from chargpt import CharDataset
+from convert_gqa import model_config
+
+# -----------------------------------------------------------------------------
+
+def get_config():
+
+    C = CN()
+    C.seed = 3407
+    C.device = 'cpu'
+    C.input_file = 'input.txt'
+    C.block_size = 128 # context of the models trained here
+
+    # models, each loaded from a chargpt.py folder or trained here
+    C.target_folder = None
+    C.draft_folder = None
+    C.target = GPT.get_default_config()
+    C.target.n_layer = 6
+    C.target.n_query_head = 6
+    C.target.n_kv_head = 6
+    C.target.n_embd = 192
+    C.target.rope = True
+    C.draft = GPT.get_default_config()
+    C.draft.n_layer = 2
+    C.draft.n_query_head = 4
+    C.draft.n_kv_head = 4
+    C.draft.n_embd = 128
+    C.draft.rope = True
+    C.trainer = Trainer.get_default_config()
+    C.trainer.learning_rate = 5e-4
+    C.trainer.num_workers = 0
+    C.trainer.max_iters = 300
+
+    # decoding
+    C.prompt = "O God, O God!"
+    C.max_new_tokens = 100
+    C.n_drafts = [2, 4, 6]
+    C.temperature = 1.0
+    C.do_sample = False
+    C.top_k = None
+    return C
+
+def build_model(config, model_config_, folder, train_dataset):
+    """ the model saved in folder, or a new one with model_config_ trained on train_dataset """
+    if folder is not None:
+        with open(os.path.join(folder, 'config.json'), 'r') as f:
+            pretrained_config = json.load(f)
+        model = GPT(model_config(pretrained_config))
+        model.load_pretrained(folder)
+    else:
+        model_config_.vocab_size = train_dataset.get_vocab_size()
+        model_config_.block_size = train_dataset.get_block_size()
+        model = GPT(model_config_)
+        trainer = Trainer(config.trainer, model, train_dataset)
+        trainer.run()
+    return model.to(config.device).eval()
+
+def time_generate(model, idx, config, **kwargs):
+    set_seed(config.seed)
+    start = time.time()
+    y, _ = model.generate(idx, config.max_new_tokens, config.temperature, config.do_sample, config.top_k, **kwargs)
+    return y, time.time() - start
+
+# -----------------------------------------------------------------------------
+
+if __name__ == '__main__':
+
+    config = get_config()
+    config.merge_from_args(sys.argv[1:])
+    set_seed(config.seed)
+
+    data_config = CharDataset.get_default_config()
+    data_config.block_size = config.block_size
+    train_dataset = CharDataset(data_config, open(config.input_file, 'r').read())
+    target = build_model(config, config.target, config.target_folder, train_dataset)
+    draft = build_model(config, config.draft, config.draft_folder, train_dataset)
+    print("target %.2fM params, draft %.2fM params" % (sum(p.numel() for p in target.parameters()) / 1e6,
+          sum(p.numel() for p in draft.parameters()) / 1e6))
+
+    idx = torch.tensor([[train_dataset.stoi[s] for s in config.prompt]], dtype=torch.long, device=config.device)
+    expected, target_dt = time_generate(target, idx, config, use_cache=True)
+    print("target alone:        %6.2fs, %8.1f tokens/s" % (target_dt, config.max_new_tokens / target_dt))
+    for n_draft in config.n_drafts:
+        y, dt = time_generate(target, idx, config, draft_model=draft, n_draft=n_draft)
+        # greedy decoding must reproduce the target's own tokens exactly
+        same = "" if config.do_sample else (", same tokens" if y.tolist() == expected.tolist() else ", DIFFERENT tokens")
+        print("speculative n_draft=%-2d %6.2fs, %8.1f tokens/s, %.1fx%s" % (n_draft, dt, config.max_new_tokens / dt,
+              target_dt / dt, same))
+    print(''.join(train_dataset.itos[int(i)] for i in expected[0]))
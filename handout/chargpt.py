@@ -14,7 +14,6 @@ from mingpt.model import GPT
 from mingpt.trainer import Trainer
 from mingpt.utils import set_seed, setup_logging, CfgNode as CN
 import pickle
-import wandb
 # -----------------------------------------------------------------------------
 
 def get_config():
@@ -91,6 +90,9 @@ class CharDataset(Dataset):
 
 if __name__ == '__main__':
 
+    # imported here so that other scripts can reuse CharDataset without wandb installed
+    import wandb
+
     wandb_api = "56d965a22c77c00b87909fad0a629ad487f9f66e"
     wandb.login(key=wandb_api)
 
@@ -167,7 +169,9 @@ if __name__ == '__main__':
                 context = "O God, O God!"
                 encoded_context = [train_dataset.stoi[s] for s in context]
                 x = torch.tensor(encoded_context, dtype=torch.long)[None,...].to(trainer.device)
-                y, attn_time = model.generate(x, 500, temperature=1.0, do_sample=True, top_k=10)
+                # with RoPE, keep streaming past block_size on attention sinks instead of recomputing
+                n_sink = 4 if config.model.rope else None
+                y, attn_time = model.generate(x, 500, temperature=1.0, do_sample=True, top_k=10, use_cache=True, n_sink=n_sink)
                 y = y[0]
                 completion = ''.join([train_dataset.itos[int(i)] for i in y])
                 print(completion)
@@ -0,0 +1,112 @@
+"""
+Converts a trained multi-head attention checkpoint into a grouped query attention one for cheap uptraining.
+The key/value heads of every layer are mean-pooled (or selected) into n_kv_head groups by GPT.load_pretrained,
+the loss of both models is reported on the same batches, and the converted model is optionally uptrained for
+a few iterations before being saved. With kv_share > 1 adjacent layers are also merged into one key/value
+projection (their mean) to cut the KV cache across layers. Example:
+
+python convert_gqa.py --pretrained_folder="'out/vanilla'" --n_kv_head=2 --trainer.max_iters=200
+"""
+
+import os
+import sys
+import json
+
+import torch
+
+from mingpt.model import GPT
+from mingpt.trainer import Trainer
+from mingpt.utils import set_seed, CfgNode as CN
+from chargpt import CharDataset
+
+# -----------------------------------------------------------------------------
+
+def get_config():
+
+    C = CN()
+
+    # system
+    C.system = CN()
+    C.system.seed = 3407
+    C.system.work_dir = './out/gqa'
+
+    # conversion
+    C.pretrained_folder = None # folder with the model.pt and config.json of the MHA model
+    C.input_file = 'input.txt'
+    C.n_kv_head = 2 # or one count per layer, e.g. [6, 6, 3, 3, 2, 2]
+    C.kv_share = 1 # number of adjacent layers that share one key/value projection
+    C.kv_pool = 'mean' # 'mean' pools the key/value heads (and layers) of a group, 'first' keeps the first one
+    C.eval_batches = 8
+    C.eval_batch_size = 64
+
+    # uptraining, skipped when max_iters is 0
+    C.trainer = Trainer.get_default_config()
+    C.trainer.max_iters = 0
+    C.trainer.learning_rate = 5e-4
+
+    return C
+
+def model_config(pretrained_config, **overrides):
+    """ a complete model config from the one saved with a checkpoint, which may predate newer options """
+    C = GPT.get_default_config()
+    C.merge_from_dict(pretrained_config['model'])
+    C.merge_from_dict(overrides)
+    return C
+
+@torch.no_grad()
+def evaluate(model, batches):
+    model.eval()
+    device = next(model.parameters()).device
+    losses = [model(x.to(device), y.to(device))[1].item() for x, y in batches]
+    return sum(losses) / len(losses)
+
+# -----------------------------------------------------------------------------
+
+if __name__ == '__main__':
+
+    config = get_config()
+    config.merge_from_args(sys.argv[1:])
+    set_seed(config.system.seed)
+    assert config.pretrained_folder is not None, "pass --pretrained_folder=<folder of the MHA checkpoint>"
+
+    with open(os.path.join(config.pretrained_folder, 'config.json'), 'r') as f:
+        pretrained_config = json.load(f)
+    text = open(config.input_file, 'r').read()
+    data_config = CharDataset.get_default_config()
+    data_config.merge_from_dict(pretrained_config['data'])
+    train_dataset = CharDataset(data_config, text)
+
+    # the reference MHA model and its GQA conversion
+    mha_model = GPT(model_config(pretrained_config))
+    mha_model.load_pretrained(config.pretrained_folder)
+    gqa_model = GPT(model_config(pretrained_config, n_kv_head=config.n_kv_head, kv_share=config.kv_share))
+    gqa_model.load_pretrained(config.pretrained_folder, kv_pool=config.kv_pool)
+
+    # score both on the same random batches
+    generator = torch.Generator().manual_seed(config.system.seed)
+    batches = []
+    for _ in range(config.eval_batches):
+        ix = torch.randint(len(train_dataset), (config.eval_batch_size,), generator=generator).tolist()
+        x, y = zip(*[train_dataset[i] for i in ix])
+        batches.append((torch.stack(x), torch.stack(y)))
+    mha_loss = evaluate(mha_model, batches)
+    gqa_loss = evaluate(gqa_model, batches)
+    print("loss: mha %.4f -> gqa (n_kv_head=%s, kv_share=%d, %s) %.4f, delta %+.4f" % (mha_loss, config.n_kv_head,
+          config.kv_share, config.kv_pool, gqa_loss, gqa_loss - mha_loss))
+    print("kv cache bytes per token: %d -> %d" % (mha_model.kv_cache_bytes_per_token(), gqa_model.kv_cache_bytes_per_token()))
+
+    if config.trainer.max_iters > 0:
+        trainer = Trainer(config.trainer, gqa_model, train_dataset)
+        trainer.run()
+        uptrained_loss = evaluate(gqa_model, batches)
+        print("loss after %d uptraining iterations: %.4f, delta %+.4f" % (config.trainer.max_iters,
+              uptrained_loss, uptrained_loss - mha_loss))
+
+    # save in the layout chargpt.py writes, so the result can be resumed with --model.pretrained_folder
+    os.makedirs(config.system.work_dir, exist_ok=True)
+    torch.save(gqa_model.state_dict(), os.path.join(config.system.work_dir, "model.pt"))
+    pretrained_config['model']['n_kv_head'] = config.n_kv_head
+    pretrained_config['model']['kv_share'] = config.kv_share
+    pretrained_config['system']['work_dir'] = config.system.work_dir
+    with open(os.path.join(config.system.work_dir, 'config.json'), 'w') as f:
+        f.write(json.dumps(pretrained_config, indent=4))
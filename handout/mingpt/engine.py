@@ -0,0 +1,123 @@
+"""
+Continuous batching on top of GPT. Requests wait in a queue and are admitted into the running batch
+at step boundaries; every step then decodes one token for all running sequences in a single batched
+forward over a PagedKVCache, and sequences retire on their stop token or length limit, freeing their
+KV blocks for the next requests in line.
+"""
+
+from collections import deque
+
+import torch
+
+from mingpt.model import KVBlockPool, PagedKVCache
+from mingpt.sampling import sample_logits
+from mingpt.utils import CfgNode as CN
+
+class Engine:
+
+    @staticmethod
+    def get_default_config():
+        C = CN()
+        # most sequences decoded together in one forward
+        C.max_batch_size = 16
+        # KV cache paging: positions per block and blocks in the pool
+        C.block_len = 16
+        C.n_blocks = None # None = enough for max_batch_size sequences of block_size positions
+        # sampling; temperature, top_k and top_p are defaults that every request can override
+        C.temperature = 1.0
+        C.do_sample = False
+        C.top_k = None
+        C.top_p = None
+        C.stop_token = None # a sequence retires right after sampling this token
+        return C
+
+    def __init__(self, config, model):
+        self.config = config
+        self.model = model
+        self.device = next(model.parameters()).device
+        n_blocks = config.n_blocks
+        if n_blocks is None:
+            n_blocks = config.max_batch_size * -(-model.block_size // config.block_len)
+        self.pool = KVBlockPool(model.n_kv_layers, n_blocks, config.block_len)
+        self.kv_cache = PagedKVCache(self.pool)
+
+        self.queue = deque() # (request id, prompt tokens, max_new_tokens, blocks, sampling) in arrival order
+        self.running = {} # request id -> dict(tokens, prompt_len, max_new_tokens, blocks, sampling)
+        self.finished = {} # request id -> prompt and generated tokens
+        self.next_id = 0
+        # blocks the running sequences may still grow into; admission keeps this within the pool,
+        # so a running sequence never finds the pool empty
+        self.reserved_blocks = 0
+        self.n_steps = 0
+
+    def add_request(self, prompt, max_new_tokens, temperature=None, top_k=None, top_p=None):
+        """
+        queue a prompt (sequence of token ids) and return its request id; temperature, top_k and top_p
+        default to the config's, a request can use temperature 0 for greedy decoding in a sampling engine
+        """
+        prompt = [int(token) for token in prompt]
+        assert 0 < len(prompt) <= self.model.block_size, f"prompts must have 1 to {self.model.block_size} tokens"
+        assert max_new_tokens >= 1, "a request must generate at least one token"
+        # blocks for the longest the sequence can get; the last sampled token is never cached
+        blocks = -(-min(len(prompt) + max_new_tokens - 1, self.model.block_size) // self.pool.block_len)
+        assert blocks <= self.pool.n_blocks, f"a request may need {blocks} KV blocks, the pool only has {self.pool.n_blocks}"
+        request_id = self.next_id
+        self.next_id += 1
+        C = self.config
+        sampling = dict(temperature=C.temperature if temperature is None else temperature,
+                        top_k=(C.top_k or 0) if top_k is None else top_k,
+                        top_p=(C.top_p or 1.0) if top_p is None else top_p)
+        self.queue.append((request_id, prompt, max_new_tokens, blocks, sampling))
+        return request_id
+
+    def _sample(self, logits, request_ids):
+        """ the next token of every request, each sampled with its own settings in one batched pass """
+        settings = [self.running[request_id]['sampling'] for request_id in request_ids]
+        per_row = {name: [sampling[name] for sampling in settings] for name in ['temperature', 'top_k', 'top_p']}
+        return sample_logits(logits, do_sample=self.config.do_sample, **per_row).view(-1).tolist()
+
+    def _append(self, request_id, token):
+        """ add a sampled token to a running sequence and retire the sequence if it is done """
+        seq = self.running[request_id]
+        seq['tokens'].append(token)
+        n_new = len(seq['tokens']) - seq['prompt_len']
+        # the newest token is cached by the next step, at position len - 1, which must fit in block_size
+        if token == self.config.stop_token or n_new >= seq['max_new_tokens'] or len(seq['tokens']) > self.model.block_size:
+            self.kv_cache.free_sequence(request_id)
+            self.reserved_blocks -= seq['blocks']
+            self.finished[request_id] = self.running.pop(request_id)['tokens']
+
+    def _admit(self):
+        """ move queued requests into the running batch while there is room, prefilling each prompt """
+        while self.queue and len(self.running) < self.config.max_batch_size:
+            request_id, prompt, max_new_tokens, blocks, sampling = self.queue[0]
+            if self.reserved_blocks + blocks > self.pool.n_blocks:
+                break
+            self.queue.popleft()
+            self.reserved_blocks += blocks
+            self.kv_cache.add_sequence(request_id)
+            self.kv_cache.set_batch([request_id])
+            logits = self.model(torch.tensor([prompt], dtype=torch.long, device=self.device), kv_cache=self.kv_cache,
+                                n_logits=1)[0]
+            self.running[request_id] = dict(tokens=prompt, prompt_len=len(prompt), max_new_tokens=max_new_tokens,
+                                            blocks=blocks, sampling=sampling)
+            self._append(request_id, self._sample(logits[:, -1, :], [request_id])[0])
+
+    @torch.no_grad()
+    def step(self):
+        """ admit what fits, then decode one token for every running sequence in one batched forward """
+        self._admit()
+        request_ids = list(self.running)
+        if request_ids:
+            self.kv_cache.set_batch(request_ids)
+            last = torch.tensor([[self.running[i]['tokens'][-1]] for i in request_ids], dtype=torch.long, device=self.device)
+            logits = self.model(last, kv_cache=self.kv_cache, n_logits=1)[0]
+            for request_id, token in zip(request_ids, self._sample(logits[:, -1, :], request_ids)):
+                self._append(request_id, token)
+        self.n_steps += 1
+
+    def run(self):
+        """ step until every queued request has finished; returns request id -> prompt + generated tokens """
+        while self.queue or self.running:
+            self.step()
+        return self.finished
@@ -15,6 +15,7 @@ import torch.nn as nn
 from torch.nn import functional as F
 
 from mingpt.utils import CfgNode as CN
+from mingpt.sampling import sample_logits, sampling_probs
 
 import time
 import os
@@ -32,6 +33,54 @@ class NewGELU(nn.Module):
     def forward(self, x):
         return 0.5 * x * (1.0 + torch.tanh(math.sqrt(2.0 / math.pi) * (x + 0.044715 * torch.pow(x, 3.0))))
 
+def _rotate_half(x, cos, sin, out, sign=1):
+    """
+    Rotate the last dimension of x into out: the first half becomes x1*cos - x2*sin and the
+    second half x2*cos + x1*sin. cos/sin hold d/2 angles and broadcast over all leading dims,
+    so the same code serves the 4-D (b, h, t, d) and 5-D (b, hkv, g, t, d) head layouts.
+    sign=-1 rotates by the negated angle (the transpose of the rotation).
+    """
+    d_2 = x.size(-1) // 2
+    x1, x2 = x[..., :d_2], x[..., d_2:]
+    out1, out2 = out[..., :d_2], out[..., d_2:]
+    torch.mul(x1, cos, out=out1)
+    out1.addcmul_(x2, sin, value=-sign)
+    torch.mul(x2, cos, out=out2)
+    out2.addcmul_(x1, sin, value=sign)
+    return out
+
+class _RotaryEmbeddingFunction(torch.autograd.Function):
+    """ RoPE with a single output allocation; the backward is the inverse rotation of the gradient """
+
+    @staticmethod
+    def forward(ctx, x, cos, sin):
+        ctx.save_for_backward(cos, sin)
+        return _rotate_half(x, cos, sin, torch.empty_like(x, memory_format=torch.contiguous_format))
+
+    @staticmethod
+    def backward(ctx, grad_out):
+        cos, sin = ctx.saved_tensors
+        grad_x = _rotate_half(grad_out, cos, sin, torch.empty_like(grad_out, memory_format=torch.contiguous_format), sign=-1)
+        return grad_x, None, None
+
+def apply_rotary_emb(x, cos, sin, seq_dim=-2):
+    """
+    Apply the rotary embedding to x of shape (..., t, d) given cos/sin tables of shape (t, d/2),
+    or (b, t, d/2) when every row of the batch has its own positions. seq_dim names the time axis
+    of x when head dims follow it, e.g. 2 for a (b, hkv, t, g, d) layout.
+    """
+    if cos.dtype != x.dtype:
+        cos, sin = cos.to(x.dtype), sin.to(x.dtype)
+    seq_dim = seq_dim % x.dim()
+    trailing = (1,) * (x.dim() - 2 - seq_dim) # head dims between time and features
+    if cos.dim() == 3:
+        # per-row tables also broadcast over the head dims sitting between batch and time
+        shape = (cos.size(0),) + (1,) * (seq_dim - 1) + (cos.size(1),) + trailing + (cos.size(2),)
+    else:
+        shape = (cos.size(0),) + trailing + (cos.size(1),)
+    cos, sin = cos.view(shape), sin.view(shape)
+    return _RotaryEmbeddingFunction.apply(x, cos, sin)
+
 class RotaryPositionalEmbeddings(nn.Module):
     """ 
     TODO: Implement RoPE introduced in the paper RoFormer: Enhanced Transformer with Rotary Position Embedding.
@@ -47,14 +96,17 @@ class RotaryPositionalEmbeddings(nn.Module):
         TODO: Initialize the class with the input arguments, as well as any values you may want to cache.
         """
 
+        assert d % 2 == 0, "RoPE rotates pairs of features, d must be even"
         self.d = d
         self.base = base
 
-        self.cache = None
+        # cos/sin tables keyed by (device, dtype); built once up to the longest length seen
+        # and sliced for shorter inputs, so repeated forwards do no trigonometry at all
+        self.cache = {}
 
         # raise NotImplementedError("Initialization is not implemented.")
 
-    def _build_cache(self, x: torch.Tensor):
+    def _build_cache(self, seq_len: int, device: torch.device, dtype: torch.dtype):
         """
         TODO: Build a cache for efficient computation of the rotary embeddings.
         Hint: A cache is used to store objects that will be used repeatedly in later computation so that 
@@ -62,59 +114,385 @@ class RotaryPositionalEmbeddings(nn.Module):
         process can be cached. 
         """
 
-        seq_len = x.shape[2]
-        theta = 1.0 / (self.base ** (torch.arange(0, self.d, 2).float() / self.d)).to(x.device)
-        seq_id = torch.arange(1,seq_len+1, device=x.device)
-        theta_i = torch.einsum('n,d->nd', seq_id, theta)
-        theta_id = torch.cat([theta_i, theta_i], dim=1)
-        self.cache = (torch.sin(theta_id),torch.cos(theta_id))
-
-    
-    def _neg_half(self, x: torch.Tensor):
-
-        d_2 = self.d // 2
-        
-        neg_sin=torch.cat([-x[:, :, :, d_2:], x[:, :, :, :d_2]], dim=-1)
-        neg_cos=torch.cat([ x[:, :, :, :d_2],x[:, :, :, d_2:]], dim=-1)
-
-        return neg_sin,neg_cos
+        key = (device, dtype)
+        cached = self.cache.get(key)
+        if cached is not None and cached[0].size(0) >= seq_len:
+            return cached
 
+        # grow geometrically so that a slowly increasing length (e.g. during generate) rarely rebuilds
+        capacity = seq_len if cached is None else max(seq_len, 2 * cached[0].size(0))
+        theta = 1.0 / (self.base ** (torch.arange(0, self.d, 2, device=device).float() / self.d))
+        seq_id = torch.arange(1, capacity + 1, device=device).float()
+        # both halves of a head share the same angles, so only d/2 columns are stored
+        theta_i = torch.einsum('n,d->nd', seq_id, theta)
+        self.cache[key] = (torch.cos(theta_i).to(dtype), torch.sin(theta_i).to(dtype))
+        return self.cache[key]
 
         # raise NotImplementedError("Rotary embeddings cache not implemented.")
 
-    def forward(self, x: torch.Tensor):
+    def get_cos_sin(self, seq_len: int, device: torch.device, dtype: torch.dtype, start_pos: int = 0, position_ids=None):
+        """
+        Return the cos/sin tables for seq_len positions starting at start_pos, each of shape (seq_len, d/2);
+        contiguous positions are served as views of the cache. Alternatively position_ids, a LongTensor
+        of shape (t,) or (b, t), selects arbitrary positions and yields tables of shape (..., t, d/2).
+        """
+        if position_ids is not None:
+            cos_cache, sin_cache = self._build_cache(int(position_ids.max()) + 1, device, dtype)
+            return cos_cache[position_ids], sin_cache[position_ids]
+        cos_cache, sin_cache = self._build_cache(start_pos + seq_len, device, dtype)
+        return cos_cache[start_pos:start_pos + seq_len], sin_cache[start_pos:start_pos + seq_len]
+
+    def forward(self, x: torch.Tensor, start_pos: int = 0, position_ids=None):
         """
         TODO: Perform the forward pass following the formula on page 13 of the writeup.
         Make sure that you are building and using your cache when necessary!
         """
-        self._build_cache(x)
-        sin_neg,cos_neg = self._neg_half(x)
+        cos, sin = self.get_cos_sin(x.shape[-2], x.device, x.dtype, start_pos, position_ids)
+        return apply_rotary_emb(x, cos, sin)
 
-        sin_cache, cos_cache = self.cache
-        sin_cache = sin_cache[None,None,:,:]
-        cos_cache = cos_cache[None,None,:,:]
+        # raise NotImplementedError("Forward pass not implemented.")
 
-        x_r = (cos_neg * cos_cache[:,:,:x.shape[2],:]) + (sin_neg * sin_cache[:,:,:x.shape[2],:])
+# -----------------------------------------------------------------------------
+# attention backends, selected per model with config.attn_impl
 
-        return x_r
+_SDPA_AVAILABLE = hasattr(F, 'scaled_dot_product_attention')
+# enable_gqa lets SDPA broadcast the key/value heads over their query groups (PyTorch >= 2.5)
+_SDPA_GQA = _SDPA_AVAILABLE and tuple(int(v) for v in torch.__version__.split('.')[:2]) >= (2, 5)
 
-        # raise NotImplementedError("Forward pass not implemented.")
+# boolean lower-triangular (banded for sliding windows) masks shared by every layer and model,
+# one per device and window, grown on demand
+_causal_masks = {}
+
+def _causal_mask(t_q, t_k, device, window=None):
+    """
+    (t_q, t_k) boolean mask, True where one of the last t_q of t_k positions may attend to a key;
+    with a sliding window only to the keys less than window positions before it
+    """
+    mask = _causal_masks.get((device, window))
+    if mask is None or mask.size(0) < t_k:
+        size = t_k if mask is None else max(t_k, 2 * mask.size(0))
+        mask = torch.ones(size, size, dtype=torch.bool, device=device).tril()
+        if window is not None:
+            mask = mask.triu(1 - window)
+        _causal_masks[(device, window)] = mask
+    return mask[t_k - t_q:t_k, :t_k]
+
+def _padding_attn_mask(attention_mask, t, window=None):
+    """
+    (b, 1, t, t_k) boolean attention mask for the last t of t_k positions of left-padded rows, from an
+    attention_mask (b, t_k) that is True (or 1) at real tokens and False at padding. Padding queries may
+    see the padding before them, which keeps their unused outputs finite.
+    """
+    key_valid = attention_mask.bool()
+    query_valid = key_valid[:, -t:]
+    causal = _causal_mask(t, key_valid.size(1), key_valid.device, window)
+    return (causal & (key_valid[:, None, :] | ~query_valid[:, :, None])).unsqueeze(1)
+
+def _resolve_attn_impl(attn_impl):
+    """ map config.attn_impl ('einsum', 'sdpa', 'tiled' or 'auto') to the backend an attention layer runs """
+    assert attn_impl in ('einsum', 'sdpa', 'tiled', 'auto'), f"unknown attn_impl {attn_impl}"
+    if attn_impl == 'auto':
+        return 'sdpa' if _SDPA_AVAILABLE else 'einsum'
+    assert attn_impl != 'sdpa' or _SDPA_AVAILABLE, "attn_impl 'sdpa' needs F.scaled_dot_product_attention (PyTorch >= 2.0)"
+    return attn_impl
+
+def _sdpa_causal_attention(q, k, v, dropout_p=0.0, window=None, attn_mask=None):
+    """
+    Causal attention through the fused F.scaled_dot_product_attention. q is (b, hq, t_q, d) and
+    k, v are (b, hkv, t_k, d), where the t_q queries are the last t_q of the t_k positions and the
+    hq query heads form hkv consecutive groups that share one key/value head. With a sliding
+    window the queries are processed in blocks of window, each against the at most 2 * window - 1
+    keys it can see, so neither the work nor the masks grow quadratically with t. An explicit
+    boolean attn_mask broadcasting to (b, hq, t_q, t_k) replaces the causal (and window) mask.
+    """
+    t_q, t_k = q.size(-2), k.size(-2)
+    kwargs = {}
+    if q.size(1) != k.size(1):
+        if _SDPA_GQA:
+            kwargs['enable_gqa'] = True
+        else:
+            group_size = q.size(1) // k.size(1)
+            k = k.repeat_interleave(group_size, dim=1)
+            v = v.repeat_interleave(group_size, dim=1)
+    if attn_mask is not None:
+        return F.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask, dropout_p=dropout_p, **kwargs)
+    if window is not None and t_k > window:
+        offset = t_k - t_q
+        out = []
+        for qs in range(0, t_q, window):
+            qe = min(qs + window, t_q)
+            ks, ke = max(0, offset + qs - window + 1), offset + qe
+            attn_mask = _causal_mask(qe - qs, ke - ks, q.device, window)
+            out.append(F.scaled_dot_product_attention(q[..., qs:qe, :], k[..., ks:ke, :], v[..., ks:ke, :],
+                                                      attn_mask=attn_mask, dropout_p=dropout_p, **kwargs))
+        return torch.cat(out, dim=-2)
+    if t_q == t_k:
+        return F.scaled_dot_product_attention(q, k, v, dropout_p=dropout_p, is_causal=True, **kwargs)
+    # is_causal aligns the mask to the top-left, which is wrong once the keys include cached positions
+    attn_mask = None if t_q == 1 else _causal_mask(t_q, t_k, q.device)
+    return F.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask, dropout_p=dropout_p, **kwargs)
+
+def _causal_key_tiles(qs, qe, t_k, offset, block_size, window=None):
+    """
+    Yield (ks, ke, needs_mask) for the key tiles visible to queries qs..qe-1, whose absolute positions
+    are offset+qs..offset+qe-1. Tiles entirely in the future are skipped, tiles entirely in the past
+    need no mask, only the ones straddling the diagonal do. With a sliding window the tiles that fell
+    out of every query's window are skipped too, and the ones straddling the window's start are masked.
+    """
+    first = 0 if window is None else max(0, offset + qs - window + 1) // block_size * block_size
+    for ks in range(first, min(t_k, offset + qe), block_size):
+        ke = min(ks + block_size, t_k)
+        yield ks, ke, ke - 1 > offset + qs or (window is not None and ks <= offset + qe - 1 - window)
+
+def _tile_mask(qs, qe, ks, ke, offset, device, window=None):
+    q_pos = torch.arange(offset + qs, offset + qe, device=device)
+    k_pos = torch.arange(ks, ke, device=device)
+    mask = k_pos[None, :] <= q_pos[:, None]
+    if window is not None:
+        mask &= k_pos[None, :] > q_pos[:, None] - window
+    return mask
+
+def _tile_dropout(shape, dropout_p, seed, device, dtype):
+    """ dropout keep-mask (already rescaled) for one tile; the seed makes it reproducible in the backward """
+    generator = torch.Generator(device=device)
+    generator.manual_seed(seed)
+    keep = torch.rand(shape, generator=generator, device=device) >= dropout_p
+    return keep.to(dtype) / (1.0 - dropout_p)
+
+class _TiledAttentionFunction(torch.autograd.Function):
+    """
+    Causal attention over (query tile, key tile) blocks with a running max and running sum, the
+    online softmax of FlashAttention, so the (t_q, t_k) score matrix is never materialized and the
+    extra memory is O(t): the output plus one log-sum-exp per query row. q is (..., t_q, d) and
+    k, v are (..., t_k, d) with leading dims that broadcast against those of q, which covers the
+    (b, h, t, d) MHA layout as well as the (b, hkv, g, t, d) GQA layout with k, v unsqueezed at g.
+    The backward pass recomputes the probabilities tile by tile from the saved log-sum-exp. An explicit
+    boolean attn_mask (..., t_q, t_k), e.g. for padded rows, is applied on top of the causal tiles.
+    """
+
+    @staticmethod
+    def forward(ctx, q, k, v, dropout_p, block_size, window, attn_mask):
+        t_q, t_k = q.size(-2), k.size(-2)
+        offset = t_k - t_q # the queries are the last t_q of the t_k positions
+        scale = 1.0 / math.sqrt(q.size(-1))
+        seed = int(torch.randint(0, 2**31, ())) if dropout_p > 0 else 0
+
+        out = q.new_empty(torch.broadcast_shapes(q.shape[:-1], v.shape[:-2] + (1,)) + (v.size(-1),))
+        lse = q.new_empty(out.shape[:-1])
+        for qs in range(0, t_q, block_size):
+            qe = min(qs + block_size, t_q)
+            q_i = q[..., qs:qe, :] * scale
+            m_i = torch.full(out[..., qs:qe, 0].shape, float('-inf'), dtype=q.dtype, device=q.device)
+            l_i = torch.zeros_like(m_i)
+            acc = torch.zeros_like(out[..., qs:qe, :])
+            for ks, ke, needs_mask in _causal_key_tiles(qs, qe, t_k, offset, block_size, window):
+                s = q_i @ k[..., ks:ke, :].transpose(-2, -1)
+                if needs_mask:
+                    s = s.masked_fill(~_tile_mask(qs, qe, ks, ke, offset, q.device, window), float('-inf'))
+                if attn_mask is not None:
+                    s = s.masked_fill(~attn_mask[..., qs:qe, ks:ke], float('-inf'))
+                m_new = torch.maximum(m_i, s.amax(dim=-1))
+                # rows that have seen no visible key yet keep a finite reference point
+                m_ref = m_new.masked_fill(m_new == float('-inf'), 0.0)
+                p = torch.exp(s - m_ref[..., None])
+                alpha = torch.exp(m_i - m_ref)
+                l_i = l_i * alpha + p.sum(dim=-1)
+                if dropout_p > 0:
+                    p = p * _tile_dropout(p.shape, dropout_p, seed + qs * t_k + ks, q.device, q.dtype)
+                acc = acc * alpha[..., None] + p @ v[..., ks:ke, :]
+                m_i = m_new
+            out[..., qs:qe, :] = acc / l_i[..., None]
+            lse[..., qs:qe] = m_i + torch.log(l_i)
+
+        ctx.save_for_backward(q, k, v, out, lse)
+        ctx.dropout_p, ctx.block_size, ctx.window, ctx.seed = dropout_p, block_size, window, seed
+        ctx.attn_mask = attn_mask
+        return out
+
+    @staticmethod
+    def backward(ctx, grad_out):
+        q, k, v, out, lse = ctx.saved_tensors
+        dropout_p, block_size, window, seed = ctx.dropout_p, ctx.block_size, ctx.window, ctx.seed
+        attn_mask = ctx.attn_mask
+        t_q, t_k = q.size(-2), k.size(-2)
+        offset = t_k - t_q
+        scale = 1.0 / math.sqrt(q.size(-1))
+
+        dq, dk, dv = torch.zeros_like(q), torch.zeros_like(k), torch.zeros_like(v)
+        delta = (grad_out * out).sum(dim=-1) # rowsum(dO * O), the softmax backward correction
+        for qs in range(0, t_q, block_size):
+            qe = min(qs + block_size, t_q)
+            q_i, do_i = q[..., qs:qe, :], grad_out[..., qs:qe, :]
+            lse_i, delta_i = lse[..., qs:qe, None], delta[..., qs:qe, None]
+            for ks, ke, needs_mask in _causal_key_tiles(qs, qe, t_k, offset, block_size, window):
+                k_j, v_j = k[..., ks:ke, :], v[..., ks:ke, :]
+                s = (q_i * scale) @ k_j.transpose(-2, -1)
+                if needs_mask:
+                    s = s.masked_fill(~_tile_mask(qs, qe, ks, ke, offset, q.device, window), float('-inf'))
+                if attn_mask is not None:
+                    s = s.masked_fill(~attn_mask[..., qs:qe, ks:ke], float('-inf'))
+                p = torch.exp(s - lse_i)
+                dp = do_i @ v_j.transpose(-2, -1)
+                if dropout_p > 0:
+                    keep = _tile_dropout(p.shape, dropout_p, seed + qs * t_k + ks, q.device, q.dtype)
+                    dv[..., ks:ke, :] += (keep * p).transpose(-2, -1).matmul(do_i).sum_to_size(v_j.shape)
+                    dp = dp * keep
+                else:
+                    dv[..., ks:ke, :] += p.transpose(-2, -1).matmul(do_i).sum_to_size(v_j.shape)
+                ds = p * (dp - delta_i) * scale
+                dq[..., qs:qe, :] += (ds @ k_j).sum_to_size(q_i.shape)
+                dk[..., ks:ke, :] += ds.transpose(-2, -1).matmul(q_i).sum_to_size(k_j.shape)
+        return dq, dk, dv, None, None, None, None
+
+def _tiled_causal_attention(q, k, v, dropout_p=0.0, block_size=128, window=None, attn_mask=None):
+    """ causal attention in O(t) extra memory, see _TiledAttentionFunction for the layouts """
+    return _TiledAttentionFunction.apply(q, k, v, dropout_p, block_size, window, attn_mask)
+
+class _ChunkedCrossEntropyFunction(torch.autograd.Function):
+    """
+    Mean cross entropy of the logits x @ weight.T (n, vocab_size) against targets (n,), computed for
+    chunk_size rows at a time so that the full logits are never materialized: the forward keeps one
+    log-sum-exp per row, and the backward recomputes the logits of every chunk from it to form
+    softmax - onehot and accumulate the gradients of x and weight. Targets equal to ignore_index are
+    left out of the loss, like F.cross_entropy does.
+    """
+
+    @staticmethod
+    def forward(ctx, x, weight, targets, ignore_index, chunk_size):
+        dtype = torch.promote_types(x.dtype, torch.float32) # the softmax runs in at least float32
+        lse = torch.empty(x.size(0), dtype=dtype, device=x.device)
+        loss = torch.zeros((), dtype=dtype, device=x.device)
+        for s in range(0, x.size(0), chunk_size):
+            e = min(s + chunk_size, x.size(0))
+            logits = (x[s:e] @ weight.t()).to(dtype)
+            lse[s:e] = torch.logsumexp(logits, dim=-1)
+            t = targets[s:e]
+            nll = lse[s:e] - logits.gather(1, t.clamp(min=0).unsqueeze(1)).squeeze(1)
+            loss += nll.masked_fill(t == ignore_index, 0).sum()
+        n_valid = (targets != ignore_index).sum()
+        ctx.save_for_backward(x, weight, targets, lse, n_valid)
+        ctx.ignore_index = ignore_index
+        ctx.chunk_size = chunk_size
+        return (loss / n_valid).to(x.dtype)
+
+    @staticmethod
+    def backward(ctx, grad_out):
+        x, weight, targets, lse, n_valid = ctx.saved_tensors
+        dx = torch.empty_like(x)
+        dweight = torch.zeros_like(weight)
+        scale = grad_out.to(lse.dtype) / n_valid
+        for s in range(0, x.size(0), ctx.chunk_size):
+            e = min(s + ctx.chunk_size, x.size(0))
+            t = targets[s:e]
+            valid = t != ctx.ignore_index
+            # d loss / d logits = (softmax - onehot(target)) / n_valid for every row that counts
+            dlogits = torch.exp((x[s:e] @ weight.t()).to(lse.dtype) - lse[s:e].unsqueeze(1))
+            dlogits.scatter_add_(1, t.clamp(min=0).unsqueeze(1), -torch.ones_like(dlogits[:, :1]))
+            dlogits = (dlogits * (valid.unsqueeze(1) * scale)).to(x.dtype)
+            dx[s:e] = dlogits @ weight
+            dweight += dlogits.t() @ x[s:e]
+        return dx, dweight, None, None, None
+
+def _chunked_cross_entropy(x, weight, targets, ignore_index=-1, chunk_size=1024):
+    """ F.cross_entropy(x @ weight.T, targets) without the full logits, see _ChunkedCrossEntropyFunction """
+    return _ChunkedCrossEntropyFunction.apply(x, weight, targets, ignore_index, chunk_size)
+
+def _layer_n_kv_head(config, layer_idx):
+    """
+    Key/value head count of layer layer_idx. config.n_kv_head is one count for every layer, a list with
+    one count per layer, or a callable mapping the layer index to a count (callables cannot be saved to
+    config.json, prefer a list there). None means one key/value head per query head.
+    """
+    n_kv_head = config.n_kv_head
+    if callable(n_kv_head):
+        n_kv_head = n_kv_head(layer_idx)
+    elif isinstance(n_kv_head, (list, tuple)):
+        assert len(n_kv_head) == config.n_layer, "n_kv_head must list one count for each of the %d layers" % config.n_layer
+        n_kv_head = n_kv_head[layer_idx]
+    return config.n_query_head if n_kv_head is None else n_kv_head
+
+def _pool_kv_heads(tensor, head_dim, n_kv_head, kv_pool):
+    """
+    Merge the key or value heads stacked along dim 0 of a projection weight/bias into n_kv_head heads.
+    Query head i is served by key/value head i // group_size, so each new head is built from a run of
+    group_size consecutive old heads: their mean (kv_pool='mean') or the first of them ('first').
+    """
+    n_head = tensor.size(0) // head_dim
+    assert n_head % n_kv_head == 0, "cannot group %d key/value heads into %d" % (n_head, n_kv_head)
+    grouped = tensor.view(n_kv_head, n_head // n_kv_head, head_dim, *tensor.shape[1:])
+    if kv_pool == 'mean':
+        pooled = grouped.mean(dim=1)
+    elif kv_pool == 'first':
+        pooled = grouped[:, 0]
+    else:
+        raise ValueError("unknown kv_pool %s, expected 'mean' or 'first'" % kv_pool)
+    return pooled.reshape(n_kv_head * head_dim, *tensor.shape[1:])
+
+def _split_qkv_state_dict(state_dict, prefix, n_embd):
+    """ split, in place, a fused qkv_proj checkpoint entry under prefix into q_proj, k_proj and v_proj """
+    for param in ('weight', 'bias'):
+        fused_name = prefix + 'qkv_proj.' + param
+        if fused_name in state_dict:
+            # the checkpoint's own key/value width follows from the size of its fused projection
+            fused = state_dict.pop(fused_name)
+            kv_dim = (fused.size(0) - n_embd) // 2
+            for name, tensor in zip(('q_proj', 'k_proj', 'v_proj'), fused.split([n_embd, kv_dim, kv_dim], dim=0)):
+                state_dict[prefix + name + '.' + param] = tensor.clone()
+
+def _convert_attn_state_dict(attn, state_dict, prefix, kv_pool=None):
+    """
+    Rewrite, in place, the checkpoint entries of one attention layer under prefix into the layout attn
+    expects: the dense causal mask buffer of older checkpoints is dropped, and separate q/k/v projections
+    are fused into qkv_proj (or a fused qkv_proj split back into q/k/v) depending on attn.fused_qkv.
+    With kv_pool set, a checkpoint with more key/value heads than attn (e.g. MHA loaded into GQA) has
+    its key/value heads pooled down, see _pool_kv_heads. A layer that reuses the keys/values of an
+    earlier layer (attn.owns_kv is False) keeps only its query projection.
+    """
+    state_dict.pop(prefix + 'bias', None)
+    _split_qkv_state_dict(state_dict, prefix, attn.n_embd)
+    names = ('q_proj', 'k_proj', 'v_proj')
+    for param in ('weight', 'bias'):
+        fused_name = prefix + 'qkv_proj.' + param
+        split_names = [prefix + name + '.' + param for name in names]
+        if not attn.owns_kv:
+            for name in split_names[1:]:
+                state_dict.pop(name, None)
+            continue
+        if not all(name in state_dict for name in split_names):
+            continue
+        if kv_pool is not None and state_dict[split_names[1]].size(0) > attn.kv_dim:
+            for name in split_names[1:]:
+                state_dict[name] = _pool_kv_heads(state_dict[name], attn.head_dim, attn.kv_dim // attn.head_dim, kv_pool)
+        if attn.fused_qkv:
+            state_dict[fused_name] = torch.cat([state_dict.pop(name) for name in split_names], dim=0)
 
 class CausalSelfAttention(nn.Module):
     """
     Simple Multi Headed attention. query heads = key heads = value heads
     """
 
-    def __init__(self, config):
+    def __init__(self, config, rotary_emb=None, layer_idx=0):
         super().__init__()
         assert config.n_embd % config.n_query_head == 0
         self.n_head = config.n_query_head
         self.n_embd = config.n_embd
-
-        # key, query, value projections
-        self.q_proj = nn.Linear(config.n_embd, config.n_embd)
-        self.k_proj = nn.Linear(config.n_embd, config.n_embd)
-        self.v_proj = nn.Linear(config.n_embd, config.n_embd)
+        self.layer_idx = layer_idx
+        # with cross-layer sharing only the first of every kv_share adjacent layers projects keys/values,
+        # the others attend to those keys/values and read the same KVCache slot
+        self.owns_kv = layer_idx % config.kv_share == 0
+        self.kv_slot = layer_idx // config.kv_share # which slot of a KVCache this layer reads and writes
+        self.head_dim = config.n_embd // config.n_query_head
+        self.kv_dim = config.n_embd # width of the keys (and values) of all heads
+
+        # key, query, value projections, optionally fused into a single GEMM whose output is split with views
+        self.fused_qkv = config.fused_qkv and self.owns_kv
+        if self.fused_qkv:
+            self.qkv_proj = nn.Linear(config.n_embd, 3 * config.n_embd)
+        else:
+            self.q_proj = nn.Linear(config.n_embd, config.n_embd)
+            if self.owns_kv:
+                self.k_proj = nn.Linear(config.n_embd, config.n_embd)
+                self.v_proj = nn.Linear(config.n_embd, config.n_embd)
 
         # output projection
         self.out_proj = nn.Linear(config.n_embd, config.n_embd)
@@ -123,54 +501,94 @@ class CausalSelfAttention(nn.Module):
         self.attn_dropout = nn.Dropout(config.attn_pdrop)
         self.resid_dropout = nn.Dropout(config.resid_pdrop)
 
-        # causal mask to ensure that attention is only applied to the left in the input sequence
-        self.register_buffer("bias", torch.tril(torch.ones(config.block_size, config.block_size))
-                                     .view(1, 1, config.block_size, config.block_size))
+        # 'einsum' is the reference implementation, 'sdpa' the fused PyTorch kernel and
+        # 'tiled' the blockwise online-softmax kernel for long sequences
+        self.attn_impl = _resolve_attn_impl(config.attn_impl)
+        # each query attends to at most the last window_size positions (itself included), None = all
+        self.window_size = config.window_size
         
         self.rope = config.rope
         if self.rope:
             """
             TODO: Initialize the RotaryPositionalEmbeddings class with the relevant arguments
             """
-            self.rotary_emb = RotaryPositionalEmbeddings(config.n_embd // config.n_query_head)
+            # GPT passes in the single table shared by all of its layers
+            if rotary_emb is None:
+                rotary_emb = RotaryPositionalEmbeddings(config.n_embd // config.n_query_head)
+            self.rotary_emb = rotary_emb
 
             # raise NotImplementedError("Attention initialization using RoPE not implemented.")
         
-    def forward(self, x):
+    def forward(self, x, rope_cache=None, start_pos=0, kv_cache=None, shared_kv=None, attn_mask=None):
         b, t, n_embd = x.size() # batch size, sequence length, embedding dimensionality (n_embd)
 
         # calculate query, key, values based on the input x
-        q = self.q_proj(x)
-        k = self.k_proj(x)
-        v = self.v_proj(x)
+        if self.fused_qkv:
+            q, k, v = self.qkv_proj(x).split(self.n_embd, dim=-1)
+        elif self.owns_kv:
+            q = self.q_proj(x)
+            k = self.k_proj(x)
+            v = self.v_proj(x)
+        else:
+            q = self.q_proj(x)
 
         # split the embedding dimension (n_embd) across the number of heads by introducing an additional 'h' dimension
         # reshape the query, key, value tensors to increase efficiency of matrix multiplication
         # b = batch size, t = sequence length, h = number of heads, d = n_embd / number of heads
         q = rearrange(q, 'b t (h d) -> b h t d', h=self.n_head)
-        k = rearrange(k, 'b t (h d) -> b h t d', h=self.n_head)
-        v = rearrange(v, 'b t (h d) -> b h t d', h=self.n_head)
+        if self.owns_kv:
+            k = rearrange(k, 'b t (h d) -> b h t d', h=self.n_head)
+            v = rearrange(v, 'b t (h d) -> b h t d', h=self.n_head)
 
         if self.rope:
             """
             TODO: Implement the forward pass using RoPE.
             """
-            q = self.rotary_emb(q)
-            k = self.rotary_emb(k)
+            # rope_cache is the (cos, sin) pair computed once per forward by GPT; on its own the
+            # layer rotates rows start_pos..start_pos+t-1, e.g. a single new token while decoding
+            if rope_cache is None:
+                if kv_cache is not None:
+                    start_pos = kv_cache.position(t)
+                rope_cache = self.rotary_emb.get_cos_sin(t, x.device, q.dtype, start_pos)
+            cos, sin = rope_cache
+            q = apply_rotary_emb(q, cos, sin)
+            if self.owns_kv:
+                k = apply_rotary_emb(k, cos, sin)
             # raise NotImplementedError("Attention forward pass using RoPE not implemented.")
 
+        if self.owns_kv:
+            # while decoding, attend over the cached keys/values of all earlier positions as well
+            if kv_cache is not None:
+                k, v = kv_cache.update(self.kv_slot, k, v)
+            if shared_kv is not None:
+                shared_kv[self.kv_slot] = (k, v)
+        else:
+            # the rotated (and cached) keys/values of the first layer of this sharing group
+            k, v = shared_kv[self.kv_slot]
+        t_k = k.size(-2)
+
         # track the memory consumed by the model
         torch.cuda.empty_cache()
         start_memory = torch.cuda.memory_allocated()
-        # compute square root of (n_embd / number of heads) to scale the dot product
-        scale = math.sqrt(k.size(-1))
-        # calculate the attention scores with the query and  key
-        att = einsum(q, k, 'b h q d, b h k d -> b h q k') / scale
-        att = att.masked_fill(self.bias[:,:,:t,:t] == 0, float('-inf'))
-        att = F.softmax(att, dim=-1)
-        att = self.attn_dropout(att)
-        # matrix multiplication of attention scores and value
-        y = einsum(att, v, 'b h q t, b h t d -> b h q d')
+        if self.attn_impl == 'sdpa':
+            y = _sdpa_causal_attention(q, k, v, self.attn_dropout.p if self.training else 0.0, self.window_size, attn_mask)
+        elif self.attn_impl == 'tiled':
+            y = _tiled_causal_attention(q, k, v, self.attn_dropout.p if self.training else 0.0,
+                                        window=self.window_size, attn_mask=attn_mask)
+        else:
+            # compute square root of (n_embd / number of heads) to scale the dot product
+            scale = math.sqrt(k.size(-1))
+            # calculate the attention scores with the query and  key
+            att = einsum(q, k, 'b h q d, b h k d -> b h q k') / scale
+            # causal mask to ensure that attention is only applied to the left in the input sequence,
+            # the t queries are the last t of the t_k positions; GPT passes attn_mask for padded rows
+            if attn_mask is None:
+                attn_mask = _causal_mask(t, t_k, x.device, self.window_size)
+            att = att.masked_fill(~attn_mask, float('-inf'))
+            att = F.softmax(att, dim=-1)
+            att = self.attn_dropout(att)
+            # matrix multiplication of attention scores and value
+            y = einsum(att, v, 'b h q t, b h t d -> b h q d')
         end_memory = torch.cuda.memory_allocated()
         # rearrange the output tensor to (batch size, sequence length, n_embd)
         y = rearrange(y, 'b h q d -> b q (h d)') # re-assemble all head outputs side by side
@@ -179,76 +597,142 @@ class CausalSelfAttention(nn.Module):
         y = self.resid_dropout(self.out_proj(y))
         return y, end_memory-start_memory
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # accept checkpoints with the legacy mask buffer and with either q/k/v projection layout
+        _convert_attn_state_dict(self, state_dict, prefix)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
 
 
 class GroupedQueryAttention(nn.Module):
     """
     Implementation of Grouped Query Attention (GQA) where the query heads are divided into groups,
-    each group sharing the same key and value heads.
+    each group sharing the same key and value heads. With n_kv_head == 1 this is multi-query
+    attention (MQA), which takes a dedicated path without any head dim on the keys and values.
     """
 
-    def __init__(self, config):
+    def __init__(self, config, rotary_emb=None, layer_idx=0):
         super().__init__()
 
       
         assert config.n_embd % config.n_query_head == 0, "n_embd must be divisible by n_query_head"
-        assert config.n_query_head % config.n_kv_head == 0, "n_query_head must be divisible by n_kv_head"
-
         self.n_query_head = config.n_query_head
-        self.n_kv_head = config.n_kv_head
+        self.n_kv_head = _layer_n_kv_head(config, layer_idx)
+        assert self.n_query_head % self.n_kv_head == 0, "n_query_head must be divisible by n_kv_head"
+
         self.n_embd = config.n_embd
         self.group_size = self.n_query_head // self.n_kv_head
         self.head_dim = self.n_embd // self.n_query_head  
-
-       
-        self.q_proj = nn.Linear(self.n_embd, self.n_embd)  
-        self.k_proj = nn.Linear(self.n_embd, self.n_kv_head * self.head_dim) 
-        self.v_proj = nn.Linear(self.n_embd, self.n_kv_head * self.head_dim)
+        self.layer_idx = layer_idx
+        self.owns_kv = layer_idx % config.kv_share == 0
+        self.kv_slot = layer_idx // config.kv_share
+        self.kv_dim = self.n_kv_head * self.head_dim
+
+        self.fused_qkv = config.fused_qkv and self.owns_kv
+        if self.fused_qkv:
+            self.qkv_proj = nn.Linear(self.n_embd, self.n_embd + 2 * self.kv_dim)
+        else:
+            self.q_proj = nn.Linear(self.n_embd, self.n_embd)  
+            if self.owns_kv:
+                self.k_proj = nn.Linear(self.n_embd, self.kv_dim) 
+                self.v_proj = nn.Linear(self.n_embd, self.kv_dim)
 
        
         self.out_proj = nn.Linear(self.n_embd, self.n_embd)
         self.attn_dropout = nn.Dropout(config.attn_pdrop)
         self.resid_dropout = nn.Dropout(config.resid_pdrop)
 
-        self.register_buffer(
-            "bias",
-            torch.tril(torch.ones(config.block_size, config.block_size))
-            .view(1, 1, 1, config.block_size, config.block_size)
-        )
+        self.attn_impl = _resolve_attn_impl(config.attn_impl)
+        self.window_size = config.window_size
 
         self.rope = config.rope
         if self.rope:
-            self.rotary_emb = RotaryPositionalEmbeddings(self.head_dim)
+            if rotary_emb is None:
+                rotary_emb = RotaryPositionalEmbeddings(self.head_dim)
+            self.rotary_emb = rotary_emb
 
-    def forward(self, x):
+    def forward(self, x, rope_cache=None, start_pos=0, kv_cache=None, shared_kv=None, attn_mask=None):
         b, t, _ = x.size()
 
-        q = self.q_proj(x)
-        k = self.k_proj(x)
-        v = self.v_proj(x)
-        q = q.view(b, t, self.n_query_head, self.head_dim)
-        q = q.permute(0, 2, 1, 3)
-        q = q.view(b, self.n_kv_head, self.group_size, t, self.head_dim)
-        k = k.view(b, t, self.n_kv_head, self.head_dim)
-        k = k.permute(0, 2, 1, 3)
-        v = v.view(b, t, self.n_kv_head, self.head_dim)
-        v = v.permute(0, 2, 1, 3)
+        if self.fused_qkv:
+            q, k, v = self.qkv_proj(x).split([self.n_embd, self.kv_dim, self.kv_dim], dim=-1)
+        elif self.owns_kv:
+            q = self.q_proj(x)
+            k = self.k_proj(x)
+            v = self.v_proj(x)
+        else:
+            q = self.q_proj(x)
+        hkv, g, d = self.n_kv_head, self.group_size, self.head_dim
+        dropout_p = self.attn_dropout.p if self.training else 0.0
+        # SDPA and the tiled kernel take queries as (b, hkv, g, t, d), a view of the projection output;
+        # the einsum path folds the group into the query rows instead, (b, hkv, t, g, d) -> (b, hkv, t*g, d),
+        # so that one GEMM per key/value head scores the whole group. No view of the (b, t, n_embd)
+        # output can put t inside hkv, so without RoPE that fold copies q once (for hkv > 1); with RoPE
+        # the rotation writes its fresh q in the folded layout and there is no extra copy.
+        fold = self.attn_impl == 'einsum'
+        q = q.view(b, t, hkv, g, d)
+        q = q.permute(0, 2, 1, 3, 4) if fold else q.permute(0, 2, 3, 1, 4)
+        if self.owns_kv:
+            k = k.view(b, t, hkv, d).transpose(1, 2)
+            v = v.view(b, t, hkv, d).transpose(1, 2)
 
         if self.rope:
-            q = self.rotary_emb(q)
-            k = self.rotary_emb(k)
-
-        scale = math.sqrt(self.head_dim)
-        att = einsum(q, k, 'b hkv g t_q d, b hkv t_k d -> b hkv g t_q t_k') / scale
-        att = att.masked_fill(self.bias[:, :, :, :t, :t] == 0, float('-inf'))
-        att = F.softmax(att, dim=-1)
-        att = self.attn_dropout(att)
+            if rope_cache is None:
+                if kv_cache is not None:
+                    start_pos = kv_cache.position(t)
+                rope_cache = self.rotary_emb.get_cos_sin(t, x.device, q.dtype, start_pos)
+            cos, sin = rope_cache
+            # the rotation writes a fresh contiguous tensor in exactly the layout above
+            q = apply_rotary_emb(q, cos, sin, seq_dim=2 if fold else 3)
+            if self.owns_kv:
+                k = apply_rotary_emb(k, cos, sin)
+
+        if self.owns_kv:
+            if kv_cache is not None:
+                k, v = kv_cache.update(self.kv_slot, k, v)
+            if shared_kv is not None:
+                shared_kv[self.kv_slot] = (k, v)
+        else:
+            k, v = shared_kv[self.kv_slot]
+        t_k = k.size(-2)
+
+        if self.attn_impl == 'sdpa':
+            # the (hkv, g) head split is exactly the grouping SDPA expects, so fold it back into hq heads
+            out = _sdpa_causal_attention(q.reshape(b, self.n_query_head, t, d), k, v, dropout_p, self.window_size, attn_mask)
+            out = out.transpose(1, 2).reshape(b, t, -1)  # [b, t, n_embd]
+        elif self.attn_impl == 'tiled':
+            # a singleton group dim on k, v broadcasts each key/value head over its query group
+            out = _tiled_causal_attention(q, k.unsqueeze(2), v.unsqueeze(2), dropout_p, window=self.window_size,
+                                          attn_mask=None if attn_mask is None else attn_mask.unsqueeze(2))
+            out = out.permute(0, 3, 1, 2, 4).reshape(b, t, -1)  # [b, t, n_embd]
+        else:
+            # query row r of the folded layout is time step r // g; attn_mask (b, 1, t, t_k) is per row
+            if attn_mask is None:
+                mask = _causal_mask(t, t_k, x.device, self.window_size).repeat_interleave(g, dim=0)
+            else:
+                mask = attn_mask.repeat_interleave(g, dim=2)
+            scale = math.sqrt(d)
+            if hkv == 1:
+                # multi-query attention: a single key/value head, so scores are one batched GEMM over
+                # (b, t*g, d) x (b, t_k, d) and the output (b, t*g, d) is already the (b, t, n_embd) layout
+                q, k, v = q.reshape(b, t * g, d), k.squeeze(1), v.squeeze(1)
+                mask = mask if attn_mask is None else mask.squeeze(1)
+                att = einsum(q, k, 'b q d, b k d -> b q k') / scale
+                att = att.masked_fill(~mask, float('-inf'))
+                att = self.attn_dropout(F.softmax(att, dim=-1))
+                out = einsum(att, v, 'b q k, b k d -> b q d').view(b, t, -1)
+            else:
+                # a view after the RoPE rotation, a copy of q without RoPE (see above)
+                q = q.reshape(b, hkv, t * g, d)
+                att = einsum(q, k, 'b hkv q d, b hkv k d -> b hkv q k') / scale
+                att = att.masked_fill(~mask, float('-inf'))
+                att = F.softmax(att, dim=-1)
+                att = self.attn_dropout(att)
 
-        out = einsum(att, v, 'b hkv g t_q t_k, b hkv t_k d -> b hkv g t_q d')
+                out = einsum(att, v, 'b hkv q k, b hkv k d -> b hkv q d')
 
-        # Reshape to combine groups back into a single tensor
-        out = out.permute(0, 3, 1, 2, 4).contiguous()
-        out = out.view(b, t, -1)  # [b, t, n_embd]
+                # Reshape to combine groups back into a single tensor
+                out = out.view(b, hkv, t, g * d).transpose(1, 2).reshape(b, t, -1)  # [b, t, n_embd]
 
         # Final output projection
         out = self.resid_dropout(self.out_proj(out))
@@ -258,17 +742,419 @@ class GroupedQueryAttention(nn.Module):
 
         return out, mem_consumed
         # raise NotImplementedError("Forward pass is not implemented.")
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        _convert_attn_state_dict(self, state_dict, prefix)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
     
+class KVCache:
+    """
+    Per-layer key/value tensors for incremental decoding. The first forward through GPT prefills
+    the cache with the prompt, every later forward only appends the keys/values of the new tokens.
+    Buffers are allocated once for max_len positions, so a decode step writes its rows in place
+    instead of re-concatenating the whole prefix. Each layer stores keys/values with the head
+    count of its own keys, i.e. only n_kv_head heads for GroupedQueryAttention; layers sharing
+    keys/values across layers (kv_share > 1) share one slot, so GPT needs only n_kv_layers slots.
+    """
+
+    def __init__(self, n_layer, max_len):
+        self.max_len = max_len
+        self.seq_len = 0 # number of positions already stored, the same for every layer
+        self.k = [None] * n_layer
+        self.v = [None] * n_layer
+
+    def update(self, layer_idx, k, v):
+        """ store k, v of shape (..., t, d) after the cached positions and return the keys/values of all positions """
+        start, end = self.seq_len, self.seq_len + k.size(-2)
+        assert end <= self.max_len, f"KVCache holds at most {self.max_len} positions"
+        if self.k[layer_idx] is None:
+            self.k[layer_idx] = k.new_empty(k.shape[:-2] + (self.max_len, k.size(-1)))
+            self.v[layer_idx] = v.new_empty(v.shape[:-2] + (self.max_len, v.size(-1)))
+        self.k[layer_idx][..., start:end, :] = k
+        self.v[layer_idx][..., start:end, :] = v
+        return self.k[layer_idx][..., :end, :], self.v[layer_idx][..., :end, :]
+
+    def position(self, t):
+        """ position (for RoPE and wpe) of the first of t new tokens, i.e. the number of cached positions """
+        return self.seq_len
+
+    def truncate(self, seq_len):
+        """ forget every cached position from seq_len on, e.g. the rejected tokens of speculative decoding """
+        self.seq_len = min(self.seq_len, seq_len)
+
+    def begin_step(self, t, device):
+        """
+        Called by GPT.forward before t new positions of every row are added. Caches whose rows hold
+        sequences of different lengths return (position_ids, attention_mask) for the step, the others None.
+        """
+        return None
+
+    def end_step(self, t):
+        """ called by GPT.forward once every layer has stored its keys/values for the t new positions """
+        self.seq_len += t
+
+    def nbytes(self):
+        """ bytes allocated by the key/value buffers of all layers """
+        return sum(t.numel() * t.element_size() for t in self.k + self.v if t is not None)
+
+class RollingKVCache(KVCache):
+    """
+    KVCache for sliding-window attention. Each layer keeps only the last window positions in a ring
+    buffer (position p in slot p % window), so memory stays constant however long decoding runs;
+    seq_len still counts every position seen, which keeps the RoPE positions going.
+    """
+
+    def __init__(self, n_layer, window):
+        super().__init__(n_layer, window)
+
+    def update(self, layer_idx, k, v):
+        """ store k, v of shape (..., t, d) and return the keys/values the new positions can attend to """
+        start, t, window = self.seq_len, k.size(-2), self.max_len
+        if self.k[layer_idx] is None:
+            self.k[layer_idx] = k.new_empty(k.shape[:-2] + (window, k.size(-1)))
+            self.v[layer_idx] = v.new_empty(v.shape[:-2] + (window, v.size(-1)))
+        cache_k, cache_v = self.k[layer_idx], self.v[layer_idx]
+        if t > 1:
+            # several queries: the window - 1 positions before them in order, followed by the new ones
+            prev = torch.arange(start - min(start, window - 1), start, device=k.device) % window
+            keys, values = torch.cat([cache_k[..., prev, :], k], dim=-2), torch.cat([cache_v[..., prev, :], v], dim=-2)
+        new = torch.arange(max(start, start + t - window), start + t, device=k.device)
+        cache_k[..., new % window, :] = k[..., new - start, :]
+        cache_v[..., new % window, :] = v[..., new - start, :]
+        if t > 1:
+            return keys, values
+        # a single query sees every stored position, so the ring order does not matter
+        n = min(start + 1, window)
+        return cache_k[..., :n, :], cache_v[..., :n, :]
+
+class SinkKVCache(KVCache):
+    """
+    KVCache for streaming generation with attention sinks (StreamingLLM): the first n_sink positions
+    are kept for good, followed by the most recent max_len - n_sink ones. RoPE sees the slots of the
+    cache instead of the positions in the text, so positions never run past max_len; whenever the
+    recent positions slide left to make room, their keys are rotated back by the same amount. Every
+    token therefore costs O(max_len) however long generation runs.
+    """
+
+    def __init__(self, n_layer, max_len, n_sink, rotary_emb):
+        assert 0 <= n_sink < max_len, "n_sink must leave room for recent positions"
+        super().__init__(n_layer, max_len)
+        self.n_sink = n_sink
+        self.rotary_emb = rotary_emb
+
+    def update(self, layer_idx, k, v):
+        """ store k, v of shape (..., t, d), evicting the oldest non-sink positions, and return all cached keys/values """
+        t = k.size(-2)
+        length = min(self.seq_len, self.max_len)
+        shift = max(0, length + t - self.max_len)
+        assert shift == 0 or shift <= length - self.n_sink, f"SinkKVCache takes at most {self.max_len - self.n_sink} positions at once"
+        if self.k[layer_idx] is None:
+            self.k[layer_idx] = k.new_empty(k.shape[:-2] + (self.max_len, k.size(-1)))
+            self.v[layer_idx] = v.new_empty(v.shape[:-2] + (self.max_len, v.size(-1)))
+        cache_k, cache_v = self.k[layer_idx], self.v[layer_idx]
+        if shift > 0:
+            # row shift - 1 of the table is the rotation by shift positions, applied here in reverse
+            cos, sin = self.rotary_emb.get_cos_sin(1, k.device, k.dtype, start_pos=shift - 1)
+            kept = slice(self.n_sink + shift, length)
+            cache_k[..., self.n_sink:length - shift, :] = apply_rotary_emb(cache_k[..., kept, :], cos, -sin)
+            cache_v[..., self.n_sink:length - shift, :] = cache_v[..., kept, :].clone()
+            length -= shift
+        cache_k[..., length:length + t, :] = k
+        cache_v[..., length:length + t, :] = v
+        return cache_k[..., :length + t, :], cache_v[..., :length + t, :]
+
+    def position(self, t):
+        # the new positions land at the end of the cache once the oldest non-sink ones are evicted
+        return min(self.seq_len, self.max_len - t)
+
+class KVBlockPool:
+    """
+    Preallocated key/value storage for paged caching: every layer slot holds n_blocks blocks of
+    block_len positions, allocated in full on the first write, and blocks are handed out to sequences
+    from a free list and returned to it when the last sequence referencing them finishes. Sequences
+    forked from a common prefix share its blocks, counted in refs, until one of them writes to a
+    shared block and gets its own copy.
+    """
+
+    def __init__(self, n_layer, n_blocks, block_len=16):
+        self.n_blocks = n_blocks
+        self.block_len = block_len
+        self.k = [None] * n_layer # (n_blocks, heads, block_len, d) per layer slot
+        self.v = [None] * n_layer
+        self.free = list(range(n_blocks - 1, -1, -1)) # popped from the end, lowest index first
+        self.refs = [0] * n_blocks # sequences referencing each block
+
+    def allocate(self):
+        assert self.free, f"KVBlockPool is out of blocks ({self.n_blocks} of {self.block_len} positions)"
+        block = self.free.pop()
+        self.refs[block] = 1
+        return block
+
+    def share(self, blocks):
+        """ add a reference to each of the blocks, e.g. for a forked sequence """
+        for block in blocks:
+            self.refs[block] += 1
+
+    def release(self, blocks):
+        """ drop a reference to each of the blocks; blocks nobody references any more become free """
+        for block in reversed(blocks):
+            self.refs[block] -= 1
+            if self.refs[block] == 0:
+                self.free.append(block)
+
+    def copy(self, block):
+        """ a new block holding the keys/values of block, with this reference to block moved to it """
+        new_block = self.allocate()
+        for k, v in zip(self.k, self.v):
+            if k is not None:
+                k[new_block] = k[block]
+                v[new_block] = v[block]
+        self.release([block])
+        return new_block
+
+    def storage(self, layer_idx, k, v):
+        """ the key/value blocks of one layer slot, shaped after k, v of shape (b, heads, t, d) """
+        if self.k[layer_idx] is None:
+            # zeros rather than empty: positions gathered as padding must hold finite values
+            self.k[layer_idx] = k.new_zeros(self.n_blocks, k.size(1), self.block_len, k.size(-1))
+            self.v[layer_idx] = v.new_zeros(self.n_blocks, v.size(1), self.block_len, v.size(-1))
+        return self.k[layer_idx], self.v[layer_idx]
+
+    def nbytes(self):
+        """ bytes preallocated by all layers """
+        return sum(t.numel() * t.element_size() for t in self.k + self.v if t is not None)
+
+    def block_nbytes(self):
+        """ bytes of one block summed over the layers, i.e. what a sequence pays per block_len positions """
+        return self.nbytes() // self.n_blocks
+
+class PagedKVCache:
+    """
+    KVCache for batched decoding of sequences with different lengths. The keys/values of a sequence
+    live in fixed-size blocks of a KVBlockPool listed in its block table, so memory follows the
+    tokens actually stored rather than block_size per row. The rows of a forward are the sequences
+    passed to set_batch; each layer gathers their keys/values through the block tables into a
+    left-padded (b, heads, t_k, d) tensor, and GPT masks the padding and positions every row itself.
+    fork_sequence starts a sequence from the blocks of another (a shared prompt, a beam's parent)
+    without copying them; a block is copied only once a sequence writes into it while it is shared.
+    """
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.block_tables = {} # sequence id -> pool blocks in position order
+        self.seq_lens = {} # sequence id -> positions stored
+        self.batch = []
+
+    def add_sequence(self, seq_id):
+        assert seq_id not in self.block_tables, f"sequence {seq_id} is already cached"
+        self.block_tables[seq_id] = []
+        self.seq_lens[seq_id] = 0
+
+    def fork_sequence(self, seq_id, new_id):
+        """ start sequence new_id with the cached positions of seq_id, sharing their blocks """
+        assert new_id not in self.block_tables, f"sequence {new_id} is already cached"
+        self.block_tables[new_id] = list(self.block_tables[seq_id])
+        self.seq_lens[new_id] = self.seq_lens[seq_id]
+        self.pool.share(self.block_tables[new_id])
+
+    def free_sequence(self, seq_id):
+        """ drop a finished sequence and return the blocks only it referenced to the pool """
+        self.pool.release(self.block_tables.pop(seq_id))
+        del self.seq_lens[seq_id]
+
+    def set_batch(self, seq_ids):
+        """ make the given sequences, in this order, the rows of the next forward """
+        self.batch = list(seq_ids)
+
+    def begin_step(self, t, device):
+        block_len = self.pool.block_len
+        for seq_id in self.batch:
+            table = self.block_tables[seq_id]
+            # copy on write: the partly filled last block may still be shared with a forked sequence
+            last = self.seq_lens[seq_id] // block_len
+            if last < len(table) and self.pool.refs[table[last]] > 1:
+                table[last] = self.pool.copy(table[last])
+            while len(table) * block_len < self.seq_lens[seq_id] + t:
+                table.append(self.pool.allocate())
+        width = max(len(self.block_tables[seq_id]) for seq_id in self.batch)
+        tables = torch.tensor([self.block_tables[seq_id] + [0] * (width - len(self.block_tables[seq_id]))
+                               for seq_id in self.batch], dtype=torch.long, device=device)
+        lens = torch.tensor([self.seq_lens[seq_id] for seq_id in self.batch], dtype=torch.long, device=device)
+        # the new positions of every row, and where they go in the pool
+        position_ids = lens[:, None] + torch.arange(t, device=device)
+        self._write = (tables.gather(1, position_ids // block_len), position_ids % block_len)
+        # key slot s of row i holds position s - (t_k - n_i): rows are left-padded to the longest one
+        n = lens + t
+        t_k = int(n.max())
+        positions = torch.arange(t_k, device=device) - (t_k - n)[:, None]
+        attention_mask = positions >= 0
+        positions = positions.clamp(min=0)
+        self._read = (tables.gather(1, positions // block_len), positions % block_len)
+        return position_ids, attention_mask
+
+    def update(self, layer_idx, k, v):
+        """ store k, v of shape (b, heads, t, d) for the rows of the batch and return their padded keys/values """
+        pool_k, pool_v = self.pool.storage(layer_idx, k, v)
+        blocks, offsets = self._write
+        pool_k[blocks, :, offsets] = k.transpose(1, 2)
+        pool_v[blocks, :, offsets] = v.transpose(1, 2)
+        blocks, offsets = self._read
+        return pool_k[blocks, :, offsets].transpose(1, 2), pool_v[blocks, :, offsets].transpose(1, 2)
+
+    def end_step(self, t):
+        for seq_id in self.batch:
+            self.seq_lens[seq_id] += t
+
+    def nbytes(self):
+        """ bytes of the pool blocks held by the cached sequences, shared blocks counted once """
+        return len(set(block for table in self.block_tables.values() for block in table)) * self.pool.block_nbytes()
+
+class _PrefixNode:
+    """ a node of the PrefixCache radix tree: an edge of tokens and their keys/values per layer slot """
+
+    def __init__(self, tokens, k, v, parent):
+        self.tokens = tokens # tuple of token ids on the edge from the parent
+        self.k = k # per layer slot (heads, len(tokens), d), None at the root
+        self.v = v
+        self.parent = parent
+        self.children = {} # first token of the child's edge -> child
+        self.last_used = 0
+
+    def nbytes(self):
+        return 0 if self.k is None else sum(t.numel() * t.element_size() for t in self.k + self.v)
+
+    def split(self, n):
+        """ cut the edge after n tokens into a new parent node, which is returned """
+        head = _PrefixNode(self.tokens[:n], [k[:, :n].clone() for k in self.k], [v[:, :n].clone() for v in self.v], self.parent)
+        head.last_used = self.last_used
+        head.children[self.tokens[n]] = self
+        self.parent.children[self.tokens[0]] = head
+        self.tokens = self.tokens[n:]
+        self.k = [k[:, n:].clone() for k in self.k]
+        self.v = [v[:, n:].clone() for v in self.v]
+        self.parent = head
+        return head
+
+class PrefixCache:
+    """
+    Keys/values of previously seen prompts, kept across GPT.generate calls. Prompts are stored in a
+    radix tree, every edge holding the keys/values of its tokens per layer slot, so prompts with a
+    common start share it; generate looks up the longest cached prefix of a new prompt, starts its
+    KVCache from there and only forwards the rest. Once the stored keys/values exceed max_bytes the
+    least recently used leaves are evicted. The entries belong to the model that computed them, use
+    one cache per model. hit_rate() and bytes_saved report how much prefill was avoided.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.root = _PrefixNode((), None, None, None)
+        self.nbytes = 0 # keys/values stored in the tree
+        self.clock = 0 # lookups and inserts so far, the timestamp for LRU eviction
+        self.n_lookups = 0
+        self.n_hits = 0 # lookups that found a prefix
+        self.n_tokens = 0 # prompt tokens looked up
+        self.n_hit_tokens = 0 # of those, tokens whose keys/values came from the cache
+        self.bytes_saved = 0 # keys/values loaded from the cache instead of computed
+
+    def _match(self, tokens):
+        """ the nodes along the longest cached prefix of tokens, and how many tokens of the last one match """
+        node, n, path = self.root, 0, []
+        while n < len(tokens) and tokens[n] in node.children:
+            node = node.children[tokens[n]]
+            common = 0
+            while common < len(node.tokens) and n + common < len(tokens) and node.tokens[common] == tokens[n + common]:
+                common += 1
+            node.last_used = self.clock
+            path.append((node, common))
+            n += common
+            if common < len(node.tokens):
+                break
+        return path
+
+    def load(self, idx, kv_cache):
+        """
+        fill an empty KVCache with the keys/values of the longest prefix of every prompt row of idx (b, t)
+        that is cached, the same number of positions for every row and at most t - 1, so that at least one
+        token is left to forward for the logits; returns the number of positions loaded
+        """
+        self.clock += 1
+        paths = [self._match(tuple(row)) for row in idx[:, :-1].tolist()]
+        n = min(sum(common for _, common in path) for path in paths)
+        self.n_lookups += len(paths)
+        self.n_hits += len(paths) if n > 0 else 0
+        self.n_tokens += idx.numel()
+        if n == 0:
+            return 0
+        for layer_idx in range(len(kv_cache.k)):
+            keys, values = [], []
+            for path in paths:
+                k, v, left = [], [], n
+                for node, common in path:
+                    k.append(node.k[layer_idx][:, :min(common, left)])
+                    v.append(node.v[layer_idx][:, :min(common, left)])
+                    left -= common
+                    if left <= 0:
+                        break
+                keys.append(torch.cat(k, dim=1))
+                values.append(torch.cat(v, dim=1))
+            kv_cache.update(layer_idx, torch.stack(keys), torch.stack(values))
+        kv_cache.end_step(n)
+        self.n_hit_tokens += n * idx.size(0)
+        self.bytes_saved += kv_cache.nbytes() // kv_cache.max_len * n
+        return n
+
+    def insert(self, idx, kv_cache):
+        """ store the keys/values of the first kv_cache.seq_len tokens of every row of idx (b, t) """
+        self.clock += 1
+        seq_len = kv_cache.seq_len
+        for row, tokens in enumerate(idx[:, :seq_len].tolist()):
+            path = self._match(tuple(tokens))
+            n = sum(common for _, common in path)
+            if n == seq_len:
+                continue
+            node = path[-1][0] if path else self.root
+            if path and path[-1][1] < len(node.tokens):
+                # the new tokens branch off in the middle of an edge
+                node = node.split(path[-1][1])
+            leaf = _PrefixNode(tuple(tokens[n:]), [k[row, :, n:seq_len].clone() for k in kv_cache.k],
+                               [v[row, :, n:seq_len].clone() for v in kv_cache.v], node)
+            leaf.last_used = self.clock
+            node.children[tokens[n]] = leaf
+            self.nbytes += leaf.nbytes()
+        self._evict()
+
+    def _evict(self):
+        """ drop least recently used leaves until the tree fits in max_bytes """
+        while self.nbytes > self.max_bytes and self.root.children:
+            leaves, stack = [], list(self.root.children.values())
+            while stack:
+                node = stack.pop()
+                if node.children:
+                    stack.extend(node.children.values())
+                else:
+                    leaves.append(node)
+            leaf = min(leaves, key=lambda node: node.last_used)
+            del leaf.parent.children[leaf.tokens[0]]
+            self.nbytes -= leaf.nbytes()
+
+    def hit_rate(self):
+        """ fraction of the prompt tokens looked up whose keys/values were loaded from the cache """
+        return self.n_hit_tokens / max(self.n_tokens, 1)
+
+    def stats(self):
+        return dict(lookups=self.n_lookups, hits=self.n_hits, hit_rate=self.hit_rate(),
+                    tokens_saved=self.n_hit_tokens, bytes_saved=self.bytes_saved, nbytes=self.nbytes)
+
 class Block(nn.Module):
     """ an unassuming Transformer block """
 
-    def __init__(self, config):
+    def __init__(self, config, rotary_emb=None, layer_idx=0):
         super().__init__()
         self.ln_1 = nn.LayerNorm(config.n_embd)
-        if config.n_query_head != config.n_kv_head:
-            self.attn = GroupedQueryAttention(config)
+        if _layer_n_kv_head(config, layer_idx) != config.n_query_head:
+            self.attn = GroupedQueryAttention(config, rotary_emb, layer_idx)
         else:
-            self.attn = CausalSelfAttention(config)
+            self.attn = CausalSelfAttention(config, rotary_emb, layer_idx)
         self.ln_2 = nn.LayerNorm(config.n_embd)
         self.mlp = nn.ModuleDict(dict(
             c_fc    = nn.Linear(config.n_embd, 4 * config.n_embd),
@@ -279,14 +1165,29 @@ class Block(nn.Module):
         m = self.mlp
         self.mlpf = lambda x: m.dropout(m.c_proj(m.act(m.c_fc(x)))) # MLP forward
 
-    def forward(self, x):
+    def forward(self, x, rope_cache=None, kv_cache=None, shared_kv=None, attn_mask=None):
         start_time = time.time()
-        attn_comp, mem_consumed = self.attn(self.ln_1(x))
+        attn_comp, mem_consumed = self.attn(self.ln_1(x), rope_cache, kv_cache=kv_cache, shared_kv=shared_kv, attn_mask=attn_mask)
         end_time = time.time()
         x = x + attn_comp
         x = x + self.mlpf(self.ln_2(x))
         return x, end_time-start_time, mem_consumed
 
+def pad_prompts(prompts, pad_token=0, device=None):
+    """
+    Left-pad prompts of different lengths (lists or 1-D tensors of token ids) into one batch. Returns
+    idx (b, t) and the boolean attention_mask (b, t) that GPT.forward and GPT.generate take, False at
+    the padding; left padding keeps the last position of every row aligned for generation.
+    """
+    t = max(len(prompt) for prompt in prompts)
+    idx = torch.full((len(prompts), t), pad_token, dtype=torch.long, device=device)
+    attention_mask = torch.zeros(len(prompts), t, dtype=torch.bool, device=device)
+    for row, prompt in enumerate(prompts):
+        if len(prompt) > 0:
+            idx[row, t - len(prompt):] = torch.as_tensor(prompt, dtype=torch.long, device=device)
+            attention_mask[row, t - len(prompt):] = True
+    return idx, attention_mask
+
 class GPT(nn.Module):
     """ GPT Language Model """
 
@@ -306,7 +1207,21 @@ class GPT(nn.Module):
         C.resid_pdrop = 0.1
         C.attn_pdrop = 0.1
         C.pretrained_folder = None
+        # key/value heads: one count for all layers, or a per-layer list/callable (see _layer_n_kv_head)
         C.n_kv_head = C.n_query_head
+        # attention backend: 'einsum' (reference), 'sdpa' (fused F.scaled_dot_product_attention),
+        # 'tiled' (blockwise online softmax in O(t) memory) or 'auto'
+        C.attn_impl = 'auto'
+        # compute q, k and v with one fused nn.Linear (qkv_proj) instead of three
+        C.fused_qkv = False
+        # number of adjacent layers that share one key/value projection and KVCache slot (1 = no sharing)
+        C.kv_share = 1
+        # sliding-window attention over the last window_size positions (None = full causal attention);
+        # with RoPE, cached generation then streams past block_size with a constant-size RollingKVCache
+        C.window_size = None
+        # compute the training loss this many rows of logits at a time (None = all at once); forward
+        # then returns no logits, as the (b * t, vocab_size) tensor is never built
+        C.ce_chunk_size = None
         return C
 
     def __init__(self, config):
@@ -315,11 +1230,20 @@ class GPT(nn.Module):
         assert config.block_size is not None
         self.block_size = config.block_size
         self.rope = config.rope
+        self.kv_share = config.kv_share
+        self.window_size = config.window_size
+        self.ce_chunk_size = config.ce_chunk_size
+        self.n_kv_layers = -(-config.n_layer // config.kv_share) # layers with their own keys/values
+        assert all(_layer_n_kv_head(config, i) == _layer_n_kv_head(config, i - i % config.kv_share)
+                   for i in range(config.n_layer)), "layers sharing keys/values must have the same n_kv_head"
+
+        # one rotary table shared by every layer; each block only applies the rotation
+        self.rotary_emb = RotaryPositionalEmbeddings(config.n_embd // config.n_query_head) if self.rope else None
 
         modules = dict(
             wte = nn.Embedding(config.vocab_size, config.n_embd),
             drop = nn.Dropout(config.embd_pdrop),
-            h = nn.ModuleList([Block(config) for _ in range(config.n_layer)]),
+            h = nn.ModuleList([Block(config, self.rotary_emb, i) for i in range(config.n_layer)]),
             ln_f = nn.LayerNorm(config.n_embd),
         )
         if self.rope==False:
@@ -336,6 +1260,25 @@ class GPT(nn.Module):
         # report number of parameters (note we don't count the decoder parameters in lm_head)
         n_params = sum(p.numel() for p in self.transformer.parameters())
         print("number of parameters: %.2fM" % (n_params/1e6,))
+        print("kv cache: %d bytes per token" % (self.kv_cache_bytes_per_token(),))
+        layer_stats = self.layer_stats()
+        if len(set(stats['n_kv_head'] for stats in layer_stats)) > 1:
+            for stats in layer_stats:
+                print("layer %d: n_kv_head %d, %.2fM parameters, kv cache %d bytes per token" % (stats['layer'],
+                      stats['n_kv_head'], stats['n_params'] / 1e6, stats['kv_bytes_per_token']))
+
+    def kv_cache_bytes_per_token(self, dtype=torch.float32):
+        """ bytes a KVCache needs per token of one sequence, summed over all layers """
+        element_size = torch.empty((), dtype=dtype).element_size()
+        return sum(2 * block.attn.kv_dim * element_size for block in self.transformer.h if block.attn.owns_kv)
+
+    def layer_stats(self, dtype=torch.float32):
+        """ key/value head count, parameter count and KVCache bytes per token of every layer """
+        element_size = torch.empty((), dtype=dtype).element_size()
+        return [dict(layer=i, attn=type(block.attn).__name__, n_kv_head=block.attn.kv_dim // block.attn.head_dim,
+                     n_params=sum(p.numel() for p in block.parameters()),
+                     kv_bytes_per_token=2 * block.attn.kv_dim * element_size if block.attn.owns_kv else 0)
+                for i, block in enumerate(self.transformer.h)]
 
     def _init_weights(self, module):
         if isinstance(module, nn.Linear):
@@ -348,24 +1291,53 @@ class GPT(nn.Module):
             torch.nn.init.zeros_(module.bias)
             torch.nn.init.ones_(module.weight)
 
-    def load_pretrained(self, model_path):
-        pretrained_state_dict = torch.load(os.path.join(model_path, "model.pt"))
+    def load_pretrained(self, model_path, kv_pool='mean'):
+        """
+        Initialize from the checkpoint in model_path (model.pt and config.json). The checkpoint may have a
+        shorter block_size, either q/k/v projection layout, and more key/value heads than this model: a
+        multi-head attention checkpoint loaded into a GroupedQueryAttention model has its key/value heads
+        mean-pooled (kv_pool='mean') or selected (kv_pool='first') into n_kv_head groups for uptraining.
+        The same applies across layers when this model shares keys/values between kv_share adjacent
+        layers: each group starts from the mean of its layers' key/value projections, or the first one's.
+        """
+        pretrained_state_dict = torch.load(os.path.join(model_path, "model.pt"), map_location='cpu')
         old_block_size = 64
         with open(os.path.join(model_path,'config.json'), 'r') as file:
             old_config = json.load(file)
             old_block_size = old_config['data']['block_size']
+        old_kv_share = old_config.get('model', {}).get('kv_share', 1)
         # Initialize the current model state dict
         self_state_dict = self.state_dict()
-
-        # Loop over the pretrained state dict and update the corresponding weights
+        prefixes = ['transformer.h.%d.attn.' % i for i in range(len(self.transformer.h))]
+        kv_names = ['k_proj.weight', 'k_proj.bias', 'v_proj.weight', 'v_proj.bias']
+        for prefix in prefixes:
+            _split_qkv_state_dict(pretrained_state_dict, prefix, self.transformer.wte.embedding_dim)
+        # give layers that reused an earlier layer's keys/values in the checkpoint their own copy ...
+        for i, prefix in enumerate(prefixes):
+            for name in kv_names:
+                source = prefixes[i - i % old_kv_share] + name
+                if prefix + name not in pretrained_state_dict and source in pretrained_state_dict:
+                    pretrained_state_dict[prefix + name] = pretrained_state_dict[source].clone()
+        # ... and average the projections of the layers this model shares keys/values between
+        if kv_pool == 'mean' and self.kv_share > 1:
+            for i in range(0, len(prefixes), self.kv_share):
+                group = prefixes[i:i + self.kv_share]
+                for name in kv_names:
+                    tensors = [pretrained_state_dict.get(prefix + name) for prefix in group]
+                    if all(tensor is not None and tensor.shape == tensors[0].shape for tensor in tensors):
+                        pretrained_state_dict[group[0] + name] = torch.stack(tensors).mean(dim=0)
+        # bring the attention entries into this model's layout (projection layout and key/value heads)
+        for prefix, block in zip(prefixes, self.transformer.h):
+            _convert_attn_state_dict(block.attn, pretrained_state_dict, prefix, kv_pool)
+
+        # Loop over the pretrained state dict and update the corresponding weights; entries the model no
+        # longer has, such as the per-layer causal mask buffers of older checkpoints, are skipped
         for name, param in pretrained_state_dict.items():
             if name in self_state_dict:
                 # If it's the wpe layer and sizes are different, handle separately
                 if name == 'transformer.wpe.weight' and param.size(0) != self_state_dict[name].size(0):
                     # Copy the weights for the first 64 neurons
                     self_state_dict[name][:old_block_size, :] = param[:old_block_size, :]
-                elif name.startswith("transformer.h.") and name.endswith(".attn.bias") and param.size()[2] != self_state_dict[name].size()[2]:
-                    self_state_dict[name][:,:,:old_block_size,:old_block_size] = param
                     # Remaining weights are already randomly initialized
                 else:
                     # Copy the weights for layers other than wpe
@@ -419,13 +1391,43 @@ class GPT(nn.Module):
         optimizer = torch.optim.AdamW(optim_groups, lr=train_config.learning_rate, betas=train_config.betas)
         return optimizer
 
-    def forward(self, idx, targets=None):
+    def forward(self, idx, targets=None, start_pos=0, kv_cache=None, position_ids=None, attention_mask=None, n_logits=None):
+        """
+        idx holds the tokens at positions start_pos..start_pos+t-1 of their sequences; start_pos > 0
+        lets a decode step embed and rotate only the new tokens. With a KVCache the offset is the
+        number of cached positions, and the keys/values of idx are appended to the cache. Rows of
+        different lengths are left-padded (see pad_prompts) and come with an attention_mask (b, t_k)
+        over all of their keys, cached ones included, that is False at the padding; the position_ids
+        (b, t) of every row then skip its padding unless given explicitly. A PagedKVCache supplies both.
+        With n_logits only the last n_logits positions are projected onto the vocabulary, the logits
+        are then (b, n_logits, vocab_size); decoding needs just the last one (n_logits=1). With
+        config.ce_chunk_size the loss is computed chunk by chunk and the logits returned are None.
+        """
+        assert n_logits is None or targets is None, "the loss needs the logits of every position"
         attn_times = []
         mem_consumed = []
         device = idx.device
         b, t = idx.size()
-        assert t <= self.block_size, f"Cannot forward sequence of length {t}, block size is only {self.block_size}"
-        pos = torch.arange(0, t, dtype=torch.long, device=device).unsqueeze(0) # shape (1, t)
+        if kv_cache is not None:
+            ragged = kv_cache.begin_step(t, device)
+            if ragged is not None:
+                position_ids, attention_mask = ragged
+            else:
+                start_pos = kv_cache.position(t)
+        if attention_mask is not None and position_ids is None:
+            # a token's position is the number of real tokens before it in its row
+            position_ids = (attention_mask.long().cumsum(dim=-1) - 1).clamp(min=0)[:, -t:]
+        if self.window_size is not None and self.rope:
+            # only positions relative to the window matter, so the sequence may run on past block_size
+            assert t <= self.block_size, f"Cannot forward {t} tokens at once, block size is only {self.block_size}"
+        elif position_ids is not None:
+            assert int(position_ids.max()) < self.block_size, f"Cannot forward position {int(position_ids.max())}, block size is only {self.block_size}"
+        else:
+            assert start_pos + t <= self.block_size, f"Cannot forward sequence of length {start_pos + t}, block size is only {self.block_size}"
+        if position_ids is not None:
+            pos = position_ids # shape (b, t)
+        else:
+            pos = torch.arange(start_pos, start_pos + t, dtype=torch.long, device=device).unsqueeze(0) # shape (1, t)
 
         # forward the GPT model itself
         tok_emb = self.transformer.wte(idx) # token embeddings of shape (b, t, n_embd)
@@ -434,48 +1436,277 @@ class GPT(nn.Module):
             x = self.transformer.drop(tok_emb + pos_emb)
         else:
             x = self.transformer.drop(tok_emb)
+        rope_cache = self.rotary_emb.get_cos_sin(t, device, x.dtype, start_pos, position_ids) if self.rope else None
+        attn_mask = None if attention_mask is None else _padding_attn_mask(attention_mask, t, self.window_size)
+        # with cross-layer sharing each group's first layer hands its keys/values on to the rest
+        shared_kv = {} if self.kv_share > 1 else None
         for block in self.transformer.h:
-            x, attn_time, mem = block(x)
+            x, attn_time, mem = block(x, rope_cache, kv_cache, shared_kv, attn_mask)
             mem_consumed.append(mem)
             attn_times.append(attn_time)
+        if kv_cache is not None:
+            kv_cache.end_step(t)
+        if n_logits is not None:
+            x = x[:, -n_logits:]
         x = self.transformer.ln_f(x)
-        logits = self.lm_head(x)
 
         # if we are given some desired targets also calculate the loss
-        loss = None
-        if targets is not None:
-            loss = F.cross_entropy(logits.view(-1, logits.size(-1)), targets.view(-1), ignore_index=-1)
+        logits, loss = None, None
+        if targets is not None and self.ce_chunk_size is not None:
+            loss = _chunked_cross_entropy(x.view(-1, x.size(-1)), self.lm_head.weight, targets.view(-1),
+                                          ignore_index=-1, chunk_size=self.ce_chunk_size)
+        else:
+            logits = self.lm_head(x)
+            if targets is not None:
+                loss = F.cross_entropy(logits.view(-1, logits.size(-1)), targets.view(-1), ignore_index=-1)
 
         return logits, loss, sum(attn_times)/len(attn_times), sum(mem_consumed)/len(mem_consumed)
 
     @torch.no_grad()
-    def generate(self, idx, max_new_tokens, temperature=1.0, do_sample=False, top_k=None):
+    def generate(self, idx, max_new_tokens, temperature=1.0, do_sample=False, top_k=None, use_cache=False, n_sink=None,
+                 attention_mask=None, draft_model=None, n_draft=4, num_samples=1, prefix_cache=None, top_p=None):
         """
         Take a conditioning sequence of indices idx (LongTensor of shape (b,t)) and complete
         the sequence max_new_tokens times, feeding the predictions back into the model each time.
         Most likely you'll want to make sure to be in model.eval() mode of operation for this.
+        With use_cache=True the first step prefills a KVCache with the prompt and every later step
+        only forwards the newly sampled token, until the sequence outgrows block_size. Sliding-window
+        models with RoPE decode with a RollingKVCache instead and never have to stop caching. So do other
+        RoPE models given n_sink: a SinkKVCache keeps the first n_sink tokens plus the most recent ones.
+        Prompts of different lengths are left-padded, with attention_mask (b, t) False at the padding
+        (see pad_prompts); such batches do not stream. Given a smaller draft_model with the same vocabulary,
+        decoding is speculative: the draft proposes n_draft tokens that this model checks in a single forward
+        (see _generate_speculative), which leaves the distribution of the output unchanged. num_samples > 1
+        completes every prompt num_samples times, in consecutive rows; with use_cache the prompt is
+        prefilled only once and its keys/values are shared by all of its samples (see _prefill_paged).
+        A PrefixCache given as prefix_cache carries prompt keys/values over from earlier calls: the cached
+        part of a prompt is not forwarded again, and the prompt is cached for later calls. It applies to
+        cached decoding with a plain KVCache, i.e. without a sliding window, n_sink or attention_mask.
+        temperature, top_k and top_p are single values or one per decoded row (see mingpt/sampling.py).
         """
+        if num_samples > 1:
+            assert draft_model is None, "speculative decoding draws one sample per prompt"
+            if use_cache:
+                return self._generate_samples(idx, max_new_tokens, num_samples, temperature, do_sample, top_k, top_p,
+                                              attention_mask)
+            idx = idx.repeat_interleave(num_samples, dim=0)
+            if attention_mask is not None:
+                attention_mask = attention_mask.repeat_interleave(num_samples, dim=0)
+        if draft_model is not None:
+            assert attention_mask is None, "speculative decoding needs prompts of the same length"
+            return self._generate_speculative(idx, max_new_tokens, draft_model, n_draft, temperature, do_sample, top_k, top_p)
         attn_times = []
+        kv_cache = None
+        assert n_sink is None or self.rope, "attention sinks re-rotate cached keys, which needs rope=True"
+        streaming = self.rope and (self.window_size is not None or n_sink is not None) and attention_mask is None
         for _ in range(max_new_tokens):
-            # if the sequence context is growing too long we must crop it at block_size
-            idx_cond = idx if idx.size(1) <= self.block_size else idx[:, -self.block_size:]
-            # forward the model to get the logits for the index in the sequence
-            logits, _,attn_time,mem_consumed = self(idx_cond)
-            # pluck the logits at the final step and scale by desired temperature
-            logits = logits[:, -1, :] / temperature
-            # optionally crop the logits to only the top k options
-            if top_k is not None:
-                v, _ = torch.topk(logits, top_k)
-                logits[logits < v[:, [-1]]] = -float('Inf')
-            # apply softmax to convert logits to (normalized) probabilities
-            probs = F.softmax(logits, dim=-1)
-            # either sample from the distribution or take the most likely element
-            if do_sample:
-                idx_next = torch.multinomial(probs, num_samples=1)
+            if use_cache and (streaming or idx.size(1) <= self.block_size):
+                if kv_cache is None:
+                    if self.window_size is not None and attention_mask is None:
+                        kv_cache = RollingKVCache(self.n_kv_layers, self.window_size)
+                    elif streaming:
+                        kv_cache = SinkKVCache(self.n_kv_layers, self.block_size, n_sink, self.rotary_emb)
+                    else:
+                        kv_cache = KVCache(self.n_kv_layers, self.block_size)
+                    # prefill with the prompt (its last block_size tokens)
+                    idx_cond = idx[:, -self.block_size:]
+                    use_prefix_cache = prefix_cache is not None and type(kv_cache) is KVCache and attention_mask is None
+                    if use_prefix_cache:
+                        # start from the longest prefix of the prompt seen before
+                        idx_cond = idx_cond[:, prefix_cache.load(idx_cond, kv_cache):]
+                    logits, _,attn_time,mem_consumed = self(idx_cond, kv_cache=kv_cache, attention_mask=attention_mask, n_logits=1)
+                    if use_prefix_cache:
+                        prefix_cache.insert(idx, kv_cache)
+                else:
+                    # everything but the last sampled token is already cached
+                    idx_cond = idx[:, -1:]
+                    logits, _,attn_time,mem_consumed = self(idx_cond, kv_cache=kv_cache, attention_mask=attention_mask, n_logits=1)
             else:
-                _, idx_next = torch.topk(probs, k=1, dim=-1)
+                # if the sequence context is growing too long we must crop it at block_size
+                # (positions shift by one every step, so the cache cannot be reused past this point)
+                idx_cond = idx if idx.size(1) <= self.block_size else idx[:, -self.block_size:]
+                mask_cond = None if attention_mask is None else attention_mask[:, -idx_cond.size(1):]
+                # forward the model to get the logits for the index in the sequence
+                logits, _,attn_time,mem_consumed = self(idx_cond, attention_mask=mask_cond, n_logits=1)
+            # pluck the logits at the final step and pick the next token from them
+            idx_next = sample_logits(logits[:, -1, :], temperature, do_sample, top_k, top_p)
             # append sampled index to the running sequence and continue
             idx = torch.cat((idx, idx_next), dim=1)
+            if attention_mask is not None:
+                attention_mask = torch.cat((attention_mask, attention_mask.new_ones(idx.size(0), 1)), dim=1)
             attn_times.append(attn_time)
 
         return idx, sum(attn_times)/len(attn_times)
+
+    def _prefill_paged(self, idx, attention_mask, n_branches, max_new_tokens):
+        """
+        Prefill a PagedKVCache with every prompt of idx (b, t) once and fork it into n_branches sequences
+        that share the prompt's blocks, copying a block only when a branch writes into it. Branch j of
+        prompt i is sequence i * n_branches + j. The pool has room for every branch to grow by
+        max_new_tokens - 1 positions, up to block_size. Returns the cache and the logits (b, vocab_size)
+        after the last token of each prompt.
+        """
+        b, t = idx.size()
+        lens = [t] * b if attention_mask is None else attention_mask.sum(dim=1).tolist()
+        block_len = 16
+        n_blocks = 0
+        for n in lens:
+            # the full blocks of the prompt are shared, everything after them is per branch
+            max_len = min(n + max(max_new_tokens - 1, 0), self.block_size)
+            n_blocks += n // block_len + n_branches * (-(-max_len // block_len) - n // block_len)
+        kv_cache = PagedKVCache(KVBlockPool(self.n_kv_layers, n_blocks, block_len))
+        for i in range(b):
+            kv_cache.add_sequence(i * n_branches)
+        if attention_mask is None:
+            kv_cache.set_batch([i * n_branches for i in range(b)])
+            logits = self(idx, kv_cache=kv_cache, n_logits=1)[0][:, -1, :]
+        else:
+            # one prompt at a time, without its padding
+            logits = []
+            for i in range(b):
+                kv_cache.set_batch([i * n_branches])
+                logits.append(self(idx[i:i+1, t - lens[i]:], kv_cache=kv_cache, n_logits=1)[0][:, -1, :])
+            logits = torch.cat(logits)
+        for i in range(b):
+            for j in range(1, n_branches):
+                kv_cache.fork_sequence(i * n_branches, i * n_branches + j)
+        return kv_cache, logits
+
+    @torch.no_grad()
+    def _generate_samples(self, idx, max_new_tokens, num_samples, temperature, do_sample, top_k, top_p, attention_mask):
+        """
+        generate with use_cache for num_samples samples of every prompt: one prefill per prompt, then
+        batched decoding of all samples over the shared blocks. Samples that outgrow block_size are
+        finished by generate without the cache, cropping as usual.
+        """
+        b = idx.size(0)
+        kv_cache, logits = self._prefill_paged(idx, attention_mask, num_samples, max_new_tokens)
+        logits = logits.repeat_interleave(num_samples, dim=0)
+        idx = idx.repeat_interleave(num_samples, dim=0)
+        if attention_mask is not None:
+            attention_mask = attention_mask.repeat_interleave(num_samples, dim=0)
+        kv_cache.set_batch(range(b * num_samples))
+        attn_times = []
+        for n_new in range(max_new_tokens):
+            if n_new > 0:
+                if max(kv_cache.seq_lens.values()) == self.block_size:
+                    # the last sampled token has no position left in the cache
+                    idx, attn_time = self.generate(idx, max_new_tokens - n_new, temperature, do_sample, top_k,
+                                                   attention_mask=attention_mask, top_p=top_p)
+                    attn_times.append(attn_time)
+                    break
+                # everything but the last sampled token is already cached
+                logits, _, attn_time, _ = self(idx[:, -1:], kv_cache=kv_cache, n_logits=1)
+                logits = logits[:, -1, :]
+                attn_times.append(attn_time)
+            idx = torch.cat((idx, sample_logits(logits, temperature, do_sample, top_k, top_p)), dim=1)
+            if attention_mask is not None:
+                attention_mask = torch.cat((attention_mask, attention_mask.new_ones(idx.size(0), 1)), dim=1)
+        return idx, sum(attn_times)/max(len(attn_times), 1)
+
+    @torch.no_grad()
+    def beam_search(self, idx, max_new_tokens, num_beams=4, attention_mask=None):
+        """
+        Complete every prompt of idx (b, t) with the num_beams continuations of max_new_tokens tokens that
+        have the highest sum of log-probabilities, keeping num_beams candidates per prompt at every step.
+        Each prompt is prefilled once (see _prefill_paged); a beam forks the cache of the beam it extends
+        and the beams left behind are freed, so beams share the blocks of their common prefix and pruning
+        only drops references. Left-padded prompts come with their attention_mask, and prompt plus
+        continuation must fit in block_size. Returns the beams (b, num_beams, t + max_new_tokens), best
+        first, and their scores (b, num_beams).
+        """
+        b, t = idx.size()
+        lens = [t] * b if attention_mask is None else attention_mask.sum(dim=1).tolist()
+        assert max(lens) + max_new_tokens - 1 <= self.block_size, f"beams cannot grow past the block size {self.block_size}"
+        kv_cache, logits = self._prefill_paged(idx, attention_mask, num_beams, max_new_tokens)
+        seq_ids = list(range(b * num_beams))
+        next_id = b * num_beams
+        # all beams of a prompt start out as the prompt itself, which only counts once
+        scores = torch.full((b, num_beams), -float('Inf'), device=idx.device)
+        scores[:, 0] = 0
+        logprobs = F.log_softmax(logits, dim=-1).unsqueeze(1).expand(-1, num_beams, -1)
+        beams = idx.unsqueeze(1).expand(-1, num_beams, -1)
+        offsets = torch.arange(b, device=idx.device).unsqueeze(1) * num_beams
+        for n_new in range(max_new_tokens):
+            if n_new > 0:
+                kv_cache.set_batch(seq_ids)
+                logits = self(beams[:, :, -1].reshape(-1, 1), kv_cache=kv_cache, n_logits=1)[0]
+                logprobs = F.log_softmax(logits[:, -1, :], dim=-1).view(b, num_beams, -1)
+            # the best num_beams (beam, token) extensions of every prompt
+            vocab_size = logprobs.size(-1)
+            scores, best = (scores.unsqueeze(-1) + logprobs).view(b, -1).topk(num_beams, dim=-1)
+            parents, tokens = best // vocab_size, best % vocab_size
+            beams = torch.cat((beams.gather(1, parents.unsqueeze(-1).expand(-1, -1, beams.size(-1))),
+                               tokens.unsqueeze(-1)), dim=2)
+            # fork the new beams from their parents before the old ones release their blocks
+            new_ids = list(range(next_id, next_id + len(seq_ids)))
+            next_id += len(seq_ids)
+            for new_id, parent in zip(new_ids, (parents + offsets).view(-1).tolist()):
+                kv_cache.fork_sequence(seq_ids[parent], new_id)
+            for seq_id in seq_ids:
+                kv_cache.free_sequence(seq_id)
+            seq_ids = new_ids
+        return beams, scores
+
+    @torch.no_grad()
+    def _generate_speculative(self, idx, max_new_tokens, draft_model, n_draft, temperature, do_sample, top_k, top_p):
+        """
+        Speculative decoding. Every round the draft model proposes n_draft tokens x_1..x_k one at a time from
+        its distributions q, and this model scores all of them in one forward over its KVCache, giving p at
+        each of the k+1 positions. Proposal x_j is accepted with probability min(1, p(x_j) / q(x_j)); the first
+        rejected one is replaced by a sample from max(0, p - q) (normalized), and when all are accepted a bonus
+        token is sampled from p after x_k. The tokens are then distributed exactly as if sampled from this model
+        alone. Rows advance together, by the fewest proposals any of them accepted plus one token, and both
+        caches are truncated back to the kept positions. Once a round no longer fits in block_size the rest of
+        the sequence is generated normally.
+        """
+        assert draft_model.lm_head.out_features == self.lm_head.out_features, "the draft model needs the same vocabulary"
+        block_size = min(self.block_size, draft_model.block_size)
+        n_total = idx.size(1) + max_new_tokens
+        kv_cache = KVCache(self.n_kv_layers, self.block_size)
+        draft_cache = KVCache(draft_model.n_kv_layers, draft_model.block_size)
+        attn_times = []
+        # a round caches up to n_draft positions past the current sequence in this model
+        while idx.size(1) < n_total and idx.size(1) + n_draft <= block_size:
+            # catch the draft up on the tokens it has not seen and let it propose n_draft more
+            x = idx[:, draft_cache.seq_len:]
+            draft_tokens, draft_probs = [], []
+            for _ in range(n_draft):
+                logits = draft_model(x, kv_cache=draft_cache, n_logits=1)[0]
+                probs = sampling_probs(logits[:, -1, :], temperature, do_sample, top_k, top_p)
+                x = torch.multinomial(probs, num_samples=1)
+                draft_tokens.append(x)
+                draft_probs.append(probs)
+            draft_tokens = torch.cat(draft_tokens, dim=1) # (b, k)
+            draft_probs = torch.stack(draft_probs, dim=1) # (b, k, vocab_size)
+
+            # one forward over the uncached tokens and the proposals scores all k+1 positions
+            logits, _, attn_time, _ = self(torch.cat((idx[:, kv_cache.seq_len:], draft_tokens), dim=1), kv_cache=kv_cache,
+                                          n_logits=n_draft + 1)
+            attn_times.append(attn_time)
+            probs = sampling_probs(logits, temperature, do_sample, top_k, top_p) # (b, k+1, vocab_size)
+
+            # accept x_j with probability p/q, i.e. when u * q < p; count each row's leading run of accepts
+            p = probs[:, :-1].gather(-1, draft_tokens.unsqueeze(-1)).squeeze(-1)
+            q = draft_probs.gather(-1, draft_tokens.unsqueeze(-1)).squeeze(-1)
+            accepted = torch.rand_like(p) * q < p
+            n_accepted = accepted.long().cumprod(dim=1).sum(dim=1) # (b,)
+            m = int(n_accepted.min())
+            if m < n_draft:
+                # rows that accepted x_{m+1} keep it, the others resample from the leftover mass of p
+                residual = (probs[:, m] - draft_probs[:, m]).clamp(min=0)
+                residual = torch.where(residual.sum(dim=-1, keepdim=True) > 0, residual, probs[:, m])
+                resampled = torch.multinomial(residual, num_samples=1).squeeze(1)
+                idx_next = torch.where(n_accepted > m, draft_tokens[:, m], resampled)
+            else:
+                idx_next = torch.multinomial(probs[:, -1], num_samples=1).squeeze(1)
+            idx = torch.cat((idx, draft_tokens[:, :m], idx_next.unsqueeze(1)), dim=1)
+            # the new last token is not cached yet, everything before it is valid in both caches
+            kv_cache.truncate(idx.size(1) - 1)
+            draft_cache.truncate(idx.size(1) - 1)
+
+        if idx.size(1) < n_total:
+            idx, attn_time = self.generate(idx, n_total - idx.size(1), temperature, do_sample, top_k, use_cache=True,
+                                           top_p=top_p)
+            attn_times.append(attn_time)
+        return idx[:, :n_total], sum(attn_times)/max(len(attn_times), 1)
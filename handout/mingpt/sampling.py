@@ -0,0 +1,101 @@
+"""
+Picking the next token from the logits of the last position, for a whole batch in one pass: greedy
+decoding, temperature, top-k and nucleus (top-p) sampling. temperature, top_k and top_p are either one
+number for the batch or one value per row (a list or tensor of b values), so requests with different
+settings can be decoded together. Rows with temperature 0 are decoded greedily, a top_k of 0 and a
+top_p of 1.0 leave a row unfiltered.
+"""
+
+import torch
+from torch.nn import functional as F
+
+# -----------------------------------------------------------------------------
+
+def _per_row(value, logits):
+    """ a per-row value as a tensor broadcasting against logits (b, ..., vocab_size); numbers and None pass through """
+    if value is None or isinstance(value, (int, float)):
+        return value
+    value = torch.as_tensor(value, device=logits.device)
+    return value.view(-1, *[1] * (logits.dim() - 1))
+
+def _candidates(logits, temperature, top_k, top_p):
+    """
+    The tokens a row may sample and their temperature-scaled logits: (values, indices) of shape
+    (..., k), values -inf where top_k or top_p drop a token, or (scaled logits, None) when nothing is
+    filtered. Only the k = max(top_k) largest logits are selected with topk, a partial sort, so small
+    top_k stay cheap at any vocab_size; top_p on its own has to sort the whole vocabulary.
+    """
+    vocab_size = logits.size(-1)
+    temperature = _per_row(temperature, logits)
+    if torch.is_tensor(temperature):
+        # greedy rows (temperature 0) are handled by the caller, keep their logits finite here
+        temperature = torch.where(temperature > 0, temperature, torch.ones_like(temperature))
+    logits = logits / temperature
+    top_k, top_p = _per_row(top_k, logits), _per_row(top_p, logits)
+    # per-row settings where no row filters (e.g. engine defaults) must not cost a full-vocabulary sort
+    if torch.is_tensor(top_k) and bool(((top_k <= 0) | (top_k >= vocab_size)).all()):
+        top_k = None
+    if torch.is_tensor(top_p) and bool((top_p >= 1).all()):
+        top_p = None
+    if top_k is None and top_p is None:
+        return logits, None
+    if top_k is None:
+        k = vocab_size
+    elif torch.is_tensor(top_k):
+        top_k = torch.where(top_k > 0, top_k, vocab_size).clamp(max=vocab_size)
+        if top_p is None and bool((top_k == vocab_size).any()):
+            # some rows are unfiltered: mask the others below their k-th largest logit, found with a topk
+            # of the largest k any filtering row asks for, rather than sorting the whole vocabulary
+            values = torch.topk(logits, int(top_k[top_k < vocab_size].max())).values
+            kth = values.gather(-1, (top_k.clamp(max=values.size(-1)) - 1).expand(*values.shape[:-1], 1))
+            kth = kth.masked_fill(top_k == vocab_size, -float('Inf'))
+            return logits.masked_fill(logits < kth, -float('Inf')), None
+        k = int(top_k.max())
+    else:
+        top_k = k = min(top_k, vocab_size) if top_k > 0 else vocab_size
+    values, indices = torch.topk(logits, k) # sorted, largest first
+    keep = torch.ones_like(values, dtype=torch.bool)
+    if torch.is_tensor(top_k):
+        keep &= torch.arange(k, device=logits.device) < top_k
+    if top_p is not None:
+        # the smallest set of the most likely tokens whose probability reaches top_p, within the top k
+        probs = F.softmax(values.masked_fill(~keep, -float('Inf')), dim=-1)
+        keep &= probs.cumsum(dim=-1) - probs < top_p
+    return values.masked_fill(~keep, -float('Inf')), indices
+
+def _greedy_rows(temperature, do_sample, logits):
+    """ a bool (b, 1, ...) tensor of the rows to decode greedily, or a bool for the whole batch """
+    if not do_sample:
+        return True
+    return _per_row(temperature, logits) <= 0
+
+def sample_logits(logits, temperature=1.0, do_sample=False, top_k=None, top_p=None):
+    """ pick the next token (b, 1) from the logits (b, vocab_size) of the last position of every row """
+    greedy = _greedy_rows(temperature, do_sample, logits)
+    if greedy is True:
+        return logits.argmax(dim=-1, keepdim=True)
+    values, indices = _candidates(logits, temperature, top_k, top_p)
+    # sample among the candidates only and map the choice back to the vocabulary
+    idx_next = torch.multinomial(F.softmax(values, dim=-1), num_samples=1)
+    if indices is not None:
+        idx_next = indices.gather(-1, idx_next)
+    if torch.is_tensor(greedy):
+        idx_next = torch.where(greedy, logits.argmax(dim=-1, keepdim=True), idx_next)
+    return idx_next
+
+def sampling_probs(logits, temperature=1.0, do_sample=False, top_k=None, top_p=None):
+    """
+    the distribution (..., vocab_size) sample_logits picks from for logits (..., vocab_size): the softmax of the
+    scaled logits cropped to the top k and top p, or all of the mass on the most likely element when not sampling
+    """
+    greedy = _greedy_rows(temperature, do_sample, logits)
+    one_hot = F.one_hot(logits.argmax(dim=-1), logits.size(-1)).to(logits.dtype)
+    if greedy is True:
+        return one_hot
+    values, indices = _candidates(logits, temperature, top_k, top_p)
+    probs = F.softmax(values, dim=-1)
+    if indices is not None:
+        probs = torch.zeros_like(logits).scatter_(-1, indices, probs)
+    if torch.is_tensor(greedy):
+        probs = torch.where(greedy, one_hot, probs)
+    return probs
@@ -1,3 +1,4 @@
+import math
 import torch
 import unittest
 import shutil
@@ -444,5 +445,866 @@ class TestModels(unittest.TestCase):
         
         raise AssertionError("Some or all dropout layers are not being applied.")
 
+    @weight(1)
+    def test_05_rope_cache(self):
+        """[T05] Test RotaryPositionalEmbeddings table reuse and growth"""
+        from mingpt import model
+        torch.manual_seed(3407)
+        rope_model = model.RotaryPositionalEmbeddings(d=8)
+        x = torch.randn(2, 3, 10, 8)
+
+        out_long = rope_model(x)
+        cos_table, _ = rope_model.cache[(x.device, x.dtype)]
+        # a shorter input is served from the existing table without rebuilding it
+        out_short = rope_model(x[:, :, :4])
+        self.assertIs(rope_model.cache[(x.device, x.dtype)][0], cos_table)
+        torch.testing.assert_close(out_short, out_long[:, :, :4])
+
+        # a longer input grows the table geometrically and matches a freshly built one
+        x_longer = torch.randn(2, 3, 13, 8)
+        out_grown = rope_model(x_longer)
+        self.assertEqual(rope_model.cache[(x.device, x.dtype)][0].size(0), 20)
+        fresh = model.RotaryPositionalEmbeddings(d=8)
+        torch.testing.assert_close(out_grown, fresh(x_longer))
+
+    @weight(1)
+    def test_06_rope_layouts(self):
+        """[T06] Test RoPE kernel against the reference rotate-half math on 4-D and 5-D inputs"""
+        from mingpt import model
+        torch.manual_seed(3407)
+        d = 8
+        rope_model = model.RotaryPositionalEmbeddings(d=d)
+
+        def reference(x):
+            t = x.shape[-2]
+            theta = 1.0 / (10000 ** (torch.arange(0, d, 2).float() / d))
+            theta_i = torch.einsum('n,d->nd', torch.arange(1, t + 1).float(), theta)
+            theta_id = torch.cat([theta_i, theta_i], dim=-1)
+            rotated = torch.cat([-x[..., d // 2:], x[..., :d // 2]], dim=-1)
+            return x * torch.cos(theta_id) + rotated * torch.sin(theta_id)
+
+        for shape in [(2, 3, 5, d), (2, 2, 3, 5, d)]:
+            x = torch.randn(*shape, requires_grad=True)
+            x_ref = x.detach().clone().requires_grad_(True)
+            grad = torch.randn(*shape)
+            out = rope_model(x)
+            out_ref = reference(x_ref)
+            torch.testing.assert_close(out, out_ref)
+            out.backward(grad)
+            out_ref.backward(grad)
+            torch.testing.assert_close(x.grad, x_ref.grad)
+
+    @weight(1)
+    def test_07_shared_rope(self):
+        """[T07] Test that all layers of a GPT share one rotary table"""
+        from mingpt import model
+        torch.manual_seed(3407)
+        C = model.GPT.get_default_config()
+        C.block_size = 32
+        C.vocab_size = 11
+        C.n_layer = 3
+        C.n_query_head = 4
+        C.n_kv_head = 2
+        C.n_embd = 16
+        C.rope = True
+        gpt = model.GPT(C)
+        self.assertTrue(all(block.attn.rotary_emb is gpt.rotary_emb for block in gpt.transformer.h))
+        idx = torch.randint(0, C.vocab_size, (2, 9))
+        gpt(idx)
+        self.assertEqual(len(gpt.rotary_emb.cache), 1)
+        self.assertFalse(any('rotary' in name for name in gpt.state_dict()))
+
+    @weight(1)
+    def test_08_rope_offsets(self):
+        """[T08] Test RoPE with a start offset and explicit position ids"""
+        from mingpt import model
+        torch.manual_seed(3407)
+        rope_model = model.RotaryPositionalEmbeddings(d=8)
+        x = torch.randn(2, 3, 12, 8)
+        full = rope_model(x)
+        # a single token rotated at its own offset matches the full-sequence rotation
+        torch.testing.assert_close(rope_model(x[:, :, 7:8], start_pos=7), full[:, :, 7:8])
+        # per-row position ids: row 0 at positions 2..5, row 1 at positions 6..9
+        position_ids = torch.stack([torch.arange(2, 6), torch.arange(6, 10)])
+        out = rope_model(x[:, :, :4], position_ids=position_ids)
+        torch.testing.assert_close(out[0], rope_model(x[0:1, :, :4], start_pos=2)[0])
+        torch.testing.assert_close(out[1], rope_model(x[1:2, :, :4], start_pos=6)[0])
+
+    @weight(1)
+    def test_09_kv_cache_generate(self):
+        """[T09] Test that cached generation matches full recomputation"""
+        from mingpt import model
+        for n_kv_head, rope in [(4, False), (4, True), (2, False), (2, True)]:
+            torch.manual_seed(3407)
+            C = model.GPT.get_default_config()
+            C.block_size = 16
+            C.vocab_size = 11
+            C.n_layer = 2
+            C.n_query_head = 4
+            C.n_kv_head = n_kv_head
+            C.n_embd = 16
+            C.rope = rope
+            gpt = model.GPT(C)
+            gpt.eval()
+            idx = torch.randint(0, C.vocab_size, (2, 5))
+            # run past block_size so that the cropped fallback is exercised as well
+            expected, _ = gpt.generate(idx, 15)
+            output, _ = gpt.generate(idx, 15, use_cache=True)
+            self.assertTrue(torch.equal(output, expected))
+
+    @weight(1)
+    def test_10_gqa_kv_cache(self):
+        """[T10] Test that GQA layers cache only n_kv_head heads"""
+        from mingpt import model
+        sizes = {}
+        for n_kv_head in [6, 1]:
+            torch.manual_seed(3407)
+            C = model.GPT.get_default_config()
+            C.block_size = 16
+            C.vocab_size = 11
+            C.n_layer = 2
+            C.n_query_head = 6
+            C.n_kv_head = n_kv_head
+            C.n_embd = 24
+            C.rope = True
+            gpt = model.GPT(C)
+            gpt.eval()
+            kv_cache = model.KVCache(C.n_layer, C.block_size)
+            gpt(torch.randint(0, C.vocab_size, (3, 5)), kv_cache=kv_cache)
+            self.assertEqual(tuple(kv_cache.k[0].shape), (3, n_kv_head, C.block_size, 4))
+            self.assertEqual(kv_cache.nbytes(), 3 * C.block_size * gpt.kv_cache_bytes_per_token())
+            sizes[n_kv_head] = gpt.kv_cache_bytes_per_token()
+        self.assertEqual(sizes[6], 6 * sizes[1])
+
+    @weight(1)
+    def test_11_attn_impl(self):
+        """[T11] Test that the SDPA and tiled backends match the einsum reference"""
+        from mingpt import model
+        for n_kv_head, rope in [(4, False), (2, True), (1, True), (1, False)]:
+            outputs = {}
+            for attn_impl in ['einsum', 'sdpa', 'tiled']:
+                torch.manual_seed(3407)
+                C = model.GPT.get_default_config()
+                C.block_size = 16
+                C.vocab_size = 11
+                C.n_layer = 2
+                C.n_query_head = 4
+                C.n_kv_head = n_kv_head
+                C.n_embd = 16
+                C.rope = rope
+                C.attn_pdrop = 0.0
+                C.attn_impl = attn_impl
+                gpt = model.GPT(C)
+                gpt.eval()
+                idx = torch.randint(0, C.vocab_size, (2, 12))
+                logits, loss, *_ = gpt(idx, idx)
+                loss.backward()
+                # prefill 7 positions, then decode the rest one token at a time
+                kv_cache = model.KVCache(C.n_layer, C.block_size)
+                decoded = [gpt(idx[:, :7], kv_cache=kv_cache)[0]]
+                decoded += [gpt(idx[:, i:i + 1], kv_cache=kv_cache)[0] for i in range(7, 12)]
+                outputs[attn_impl] = (logits, gpt.lm_head.weight.grad, torch.cat(decoded, dim=1))
+            for attn_impl in ['sdpa', 'tiled']:
+                for reference, fused in zip(outputs['einsum'], outputs[attn_impl]):
+                    torch.testing.assert_close(fused, reference, atol=1e-5, rtol=1e-4)
+
+    @weight(1)
+    def test_12_tiled_attention(self):
+        """[T12] Test the tiled online-softmax attention kernel and its backward pass"""
+        from mingpt import model
+        torch.manual_seed(3407)
+        # MHA layout, GQA layout with a broadcast group dim, and queries at the end of a longer key range
+        for q_shape, kv_shape in [((2, 3, 11, 4), (2, 3, 11, 4)),
+                                  ((2, 2, 3, 11, 4), (2, 2, 1, 11, 4)),
+                                  ((2, 3, 5, 4), (2, 3, 11, 4))]:
+            q = torch.randn(*q_shape, dtype=torch.double, requires_grad=True)
+            k = torch.randn(*kv_shape, dtype=torch.double, requires_grad=True)
+            v = torch.randn(*kv_shape, dtype=torch.double, requires_grad=True)
+            t_q, t_k = q.size(-2), k.size(-2)
+            mask = torch.ones(t_q, t_k, dtype=torch.bool).tril(t_k - t_q)
+            att = (q @ k.transpose(-2, -1) / 2.0).masked_fill(~mask, float('-inf'))
+            expected = torch.softmax(att, dim=-1) @ v
+            torch.testing.assert_close(model._tiled_causal_attention(q, k, v, 0.0, 4), expected)
+            self.assertTrue(torch.autograd.gradcheck(lambda q, k, v: model._tiled_causal_attention(q, k, v, 0.0, 4), (q, k, v)))
+
+    @weight(1)
+    def test_13_no_mask_buffers(self):
+        """[T13] Test that checkpoints hold no causal mask buffers and legacy ones still load"""
+        from mingpt import model
+        for n_kv_head in [4, 2]:
+            torch.manual_seed(3407)
+            C = model.GPT.get_default_config()
+            C.block_size = 16
+            C.vocab_size = 11
+            C.n_layer = 2
+            C.n_query_head = 4
+            C.n_kv_head = n_kv_head
+            C.n_embd = 16
+            C.rope = False
+            gpt = model.GPT(C)
+            state_dict = gpt.state_dict()
+            self.assertFalse(any(name.endswith('.attn.bias') for name in state_dict))
+            legacy = dict(state_dict)
+            for i in range(C.n_layer):
+                legacy['transformer.h.%d.attn.bias' % i] = torch.ones(1, 1, C.block_size, C.block_size).tril()
+            model.GPT(C).load_state_dict(legacy)
+
+    @weight(1)
+    def test_14_fused_qkv(self):
+        """[T14] Test fused QKV projections and checkpoint conversion in both directions"""
+        from mingpt import model
+        for n_kv_head in [4, 2]:
+            models = {}
+            for fused_qkv in [False, True]:
+                torch.manual_seed(3407)
+                C = model.GPT.get_default_config()
+                C.block_size = 16
+                C.vocab_size = 11
+                C.n_layer = 2
+                C.n_query_head = 4
+                C.n_kv_head = n_kv_head
+                C.n_embd = 16
+                C.rope = True
+                C.fused_qkv = fused_qkv
+                models[fused_qkv] = model.GPT(C).eval()
+            idx = torch.randint(0, 11, (2, 9))
+            # separate -> fused
+            models[True].load_state_dict(models[False].state_dict())
+            torch.testing.assert_close(models[True](idx)[0], models[False](idx)[0])
+            # fused -> separate
+            fused_state = {name: param + 0.01 for name, param in models[True].state_dict().items()}
+            models[True].load_state_dict(fused_state)
+            models[False].load_state_dict(fused_state)
+            torch.testing.assert_close(models[False](idx)[0], models[True](idx)[0])
+
+    @weight(1)
+    def test_15_mha_to_gqa_conversion(self):
+        """[T15] Test converting an MHA checkpoint into a GQA model by pooling key/value heads"""
+        import json
+        import tempfile
+        from mingpt import model
+
+        def make_config(n_kv_head):
+            C = model.GPT.get_default_config()
+            C.block_size = 16
+            C.vocab_size = 11
+            C.n_layer = 2
+            C.n_query_head = 4
+            C.n_kv_head = n_kv_head
+            C.n_embd = 16
+            C.rope = True
+            return C
+
+        torch.manual_seed(3407)
+        mha = model.GPT(make_config(4)).eval()
+        # make the key/value heads identical within each group of 2, so pooling them loses nothing
+        with torch.no_grad():
+            for block in mha.transformer.h:
+                for proj in [block.attn.k_proj, block.attn.v_proj]:
+                    for tensor in [proj.weight, proj.bias]:
+                        heads = tensor.view(2, 2, 4, *tensor.shape[1:])
+                        heads[:, 1].copy_(heads[:, 0])
+        idx = torch.randint(0, 11, (2, 9))
+        with tempfile.TemporaryDirectory() as folder:
+            torch.save(mha.state_dict(), os.path.join(folder, 'model.pt'))
+            with open(os.path.join(folder, 'config.json'), 'w') as f:
+                json.dump({'data': {'block_size': 16}}, f)
+            for kv_pool in ['mean', 'first']:
+                gqa = model.GPT(make_config(2)).eval()
+                gqa.load_pretrained(folder, kv_pool=kv_pool)
+                self.assertEqual(tuple(gqa.transformer.h[0].attn.k_proj.weight.shape), (8, 16))
+                torch.testing.assert_close(gqa(idx)[0], mha(idx)[0])
+            with self.assertRaises(ValueError):
+                model.GPT(make_config(2)).load_pretrained(folder, kv_pool='max')
+
+    @weight(1)
+    def test_16_per_layer_kv_heads(self):
+        """[T16] Test per-layer n_kv_head schedules given as a list or a callable"""
+        from mingpt import model
+        schedule = [4, 2, 1]
+        models = {}
+        for name, n_kv_head in [('list', schedule), ('callable', lambda i: 4 >> i)]:
+            torch.manual_seed(3407)
+            C = model.GPT.get_default_config()
+            C.block_size = 16
+            C.vocab_size = 11
+            C.n_layer = 3
+            C.n_query_head = 4
+            C.n_kv_head = n_kv_head
+            C.n_embd = 16
+            C.rope = True
+            models[name] = model.GPT(C).eval()
+        gpt = models['list']
+        self.assertEqual([type(block.attn).__name__ for block in gpt.transformer.h],
+                         ['CausalSelfAttention', 'GroupedQueryAttention', 'GroupedQueryAttention'])
+        stats = gpt.layer_stats()
+        self.assertEqual([s['n_kv_head'] for s in stats], schedule)
+        self.assertEqual([s['kv_bytes_per_token'] for s in stats], [2 * h * 4 * 4 for h in schedule])
+        self.assertEqual(sum(s['kv_bytes_per_token'] for s in stats), gpt.kv_cache_bytes_per_token())
+        self.assertTrue(stats[0]['n_params'] > stats[1]['n_params'] > stats[2]['n_params'])
+        # both spellings of the schedule build the same model
+        idx = torch.randint(0, 11, (2, 9))
+        models['callable'].load_state_dict(gpt.state_dict())
+        torch.testing.assert_close(models['callable'](idx)[0], gpt(idx)[0])
+        # cached decoding with a different key/value width in every layer
+        torch.manual_seed(0)
+        y_full, _ = gpt.generate(idx, 5)
+        y_cached, _ = gpt.generate(idx, 5, use_cache=True)
+        self.assertTrue(torch.equal(y_full, y_cached))
+
+    @weight(1)
+    def test_17_cross_layer_kv_sharing(self):
+        """[T17] Test sharing keys/values between adjacent layers"""
+        import json
+        import tempfile
+        from mingpt import model
+
+        def make_config(kv_share, attn_impl='auto', fused_qkv=False):
+            C = model.GPT.get_default_config()
+            C.block_size = 16
+            C.vocab_size = 11
+            C.n_layer = 4
+            C.n_query_head = 4
+            C.n_kv_head = [4, 4, 2, 2]
+            C.n_embd = 16
+            C.rope = True
+            C.kv_share = kv_share
+            C.attn_impl = attn_impl
+            C.fused_qkv = fused_qkv
+            return C
+
+        torch.manual_seed(3407)
+        base = model.GPT(make_config(1)).eval()
+        shared = model.GPT(make_config(2)).eval()
+        self.assertEqual(shared.n_kv_layers, 2)
+        self.assertEqual([hasattr(block.attn, 'k_proj') for block in shared.transformer.h], [True, False, True, False])
+        self.assertEqual(shared.kv_cache_bytes_per_token(), base.kv_cache_bytes_per_token() // 2)
+        # every backend and projection layout gives the same result and decodes with half the cache slots
+        idx = torch.randint(0, 11, (2, 9))
+        expected = shared(idx)[0]
+        for attn_impl in ['einsum', 'sdpa', 'tiled']:
+            for fused_qkv in [False, True]:
+                gpt = model.GPT(make_config(2, attn_impl, fused_qkv)).eval()
+                gpt.load_state_dict(shared.state_dict())
+                torch.testing.assert_close(gpt(idx)[0], expected)
+        kv_cache = model.KVCache(shared.n_kv_layers, 16)
+        torch.testing.assert_close(shared(idx[:, :5], kv_cache=kv_cache)[0], expected[:, :5])
+        torch.testing.assert_close(shared(idx[:, 5:], kv_cache=kv_cache)[0], expected[:, 5:])
+        self.assertEqual(kv_cache.nbytes(), 16 * shared.kv_cache_bytes_per_token() * 2)
+        y_full, _ = shared.generate(idx, 5)
+        y_cached, _ = shared.generate(idx, 5, use_cache=True)
+        self.assertTrue(torch.equal(y_full, y_cached))
+        # load_pretrained starts each sharing group from the mean of its layers' key/value projections
+        with tempfile.TemporaryDirectory() as folder:
+            torch.save(base.state_dict(), os.path.join(folder, 'model.pt'))
+            with open(os.path.join(folder, 'config.json'), 'w') as f:
+                json.dump({'data': {'block_size': 16}}, f)
+            shared.load_pretrained(folder)
+        for i in [0, 2]:
+            for name in ['k_proj', 'v_proj']:
+                mean = (getattr(base.transformer.h[i].attn, name).weight + getattr(base.transformer.h[i + 1].attn, name).weight) / 2
+                torch.testing.assert_close(getattr(shared.transformer.h[i].attn, name).weight, mean)
+        torch.testing.assert_close(shared.transformer.h[1].attn.q_proj.weight, base.transformer.h[1].attn.q_proj.weight)
+
+    @weight(1)
+    def test_18_sliding_window(self):
+        """[T18] Test sliding-window attention and the rolling KV cache"""
+        from mingpt import model
+        # the tiled kernel skips and masks whole key tiles around the window, forward and backward
+        torch.manual_seed(3407)
+        q = torch.randn(2, 3, 19, 8, requires_grad=True)
+        k = torch.randn(2, 3, 23, 8, requires_grad=True)
+        v = torch.randn(2, 3, 23, 8, requires_grad=True)
+        for window in [1, 5, 9]:
+            mask = model._causal_mask(19, 23, q.device, window)
+            att = (q @ k.transpose(-2, -1) / math.sqrt(8)).masked_fill(~mask, float('-inf'))
+            expected = torch.softmax(att, dim=-1) @ v
+            expected_grads = torch.autograd.grad(expected.sum(), (q, k, v))
+            for attend in [lambda: model._tiled_causal_attention(q, k, v, block_size=4, window=window),
+                           lambda: model._sdpa_causal_attention(q, k, v, window=window)]:
+                out = attend()
+                torch.testing.assert_close(out, expected)
+                for grad, expected_grad in zip(torch.autograd.grad(out.sum(), (q, k, v)), expected_grads):
+                    torch.testing.assert_close(grad, expected_grad)
+
+        def make_config(block_size, n_kv_head, attn_impl):
+            C = model.GPT.get_default_config()
+            C.block_size = block_size
+            C.vocab_size = 11
+            C.n_layer = 2
+            C.n_query_head = 4
+            C.n_kv_head = n_kv_head
+            C.n_embd = 16
+            C.rope = True
+            C.window_size = 6
+            C.attn_impl = attn_impl
+            return C
+
+        for n_kv_head in [4, 2]:
+            for attn_impl in ['einsum', 'sdpa', 'tiled']:
+                torch.manual_seed(3407)
+                gpt = model.GPT(make_config(16, n_kv_head, attn_impl)).eval()
+                # the same weights without the block_size limit give the reference for long sequences
+                reference = model.GPT(make_config(64, n_kv_head, 'einsum')).eval()
+                reference.load_state_dict(gpt.state_dict())
+                idx = torch.randint(0, 11, (2, 40))
+                expected = reference(idx)[0]
+                # decode well past block_size with a cache that never holds more than window positions
+                kv_cache = model.RollingKVCache(gpt.n_kv_layers, 6)
+                logits = [gpt(idx[:, :10], kv_cache=kv_cache)[0], gpt(idx[:, 10:17], kv_cache=kv_cache)[0]]
+                nbytes = kv_cache.nbytes()
+                logits += [gpt(idx[:, i:i + 1], kv_cache=kv_cache)[0] for i in range(17, 40)]
+                self.assertEqual(kv_cache.nbytes(), nbytes)
+                self.assertEqual(nbytes, 2 * 6 * gpt.kv_cache_bytes_per_token())
+                torch.testing.assert_close(torch.cat(logits, dim=1), expected)
+        y, _ = gpt.generate(idx[:, :10], 30, use_cache=True)
+        self.assertEqual(y.size(1), 40)
+
+    @weight(1)
+    def test_19_attention_sinks(self):
+        """[T19] Test streaming generation with attention sinks past block_size"""
+        from mingpt import model
+        for n_kv_head in [4, 2]:
+            for attn_impl in ['einsum', 'sdpa']:
+                torch.manual_seed(3407)
+                C = model.GPT.get_default_config()
+                C.block_size = 8
+                C.vocab_size = 11
+                C.n_layer = 1
+                C.n_query_head = 4
+                C.n_kv_head = n_kv_head
+                C.n_embd = 16
+                C.rope = True
+                C.attn_impl = attn_impl
+                gpt = model.GPT(C).eval()
+                idx = torch.randint(0, 11, (2, 30))
+                kv_cache = model.SinkKVCache(gpt.n_kv_layers, 8, 2, gpt.rotary_emb)
+                logits = gpt(idx[:, :5], kv_cache=kv_cache)[0]
+                torch.testing.assert_close(logits, gpt(idx[:, :5])[0])
+                nbytes = None
+                for i in range(5, 30):
+                    logits = gpt(idx[:, i:i + 1], kv_cache=kv_cache)[0]
+                    # with a single layer the cached keys depend only on their tokens and cache slots, so the
+                    # step equals a fresh forward over the sinks followed by the most recent tokens
+                    context = torch.cat([idx[:, :2], idx[:, max(2, i - 5):i + 1]], dim=1)
+                    torch.testing.assert_close(logits[:, -1], gpt(context)[0][:, -1])
+                    if i >= 8:
+                        nbytes = nbytes or kv_cache.nbytes()
+                        self.assertEqual(kv_cache.nbytes(), nbytes)
+                self.assertEqual(kv_cache.seq_len, 30)
+                y, _ = gpt.generate(idx[:, :10], 20, use_cache=True, n_sink=2)
+                self.assertEqual(y.size(1), 30)
+        # sinks need RoPE to re-rotate the kept keys; without it n_sink is an error, not a silent no-op
+        C.rope = False
+        gpt = model.GPT(C).eval()
+        with self.assertRaises(AssertionError):
+            gpt.generate(idx[:, :10], 20, use_cache=True, n_sink=2)
+
+    @weight(1)
+    def test_20_paged_kv_cache(self):
+        """[T20] Test the paged KV cache with sequences of different lengths in one batch"""
+        from mingpt import model
+        for n_kv_head, attn_impl in [(4, 'einsum'), (2, 'sdpa'), (1, 'tiled'), (2, 'einsum')]:
+            torch.manual_seed(3407)
+            C = model.GPT.get_default_config()
+            C.block_size = 32
+            C.vocab_size = 11
+            C.n_layer = 2
+            C.n_query_head = 4
+            C.n_kv_head = n_kv_head
+            C.n_embd = 16
+            C.rope = n_kv_head != 1
+            C.attn_impl = attn_impl
+            gpt = model.GPT(C).eval()
+            pool = model.KVBlockPool(gpt.n_kv_layers, n_blocks=16, block_len=4)
+            kv_cache = model.PagedKVCache(pool)
+            seqs = [torch.randint(0, 11, (n,)) for n in [3, 9, 5]]
+            # prefill every prompt on its own, then decode all of them together
+            for i, seq in enumerate(seqs):
+                kv_cache.add_sequence(i)
+                kv_cache.set_batch([i])
+                torch.testing.assert_close(gpt(seq[None], kv_cache=kv_cache)[0], gpt(seq[None])[0])
+            kv_cache.set_batch([0, 1, 2])
+            for step in [1, 1, 2, 1]:
+                new = torch.randint(0, 11, (3, step))
+                logits = gpt(new, kv_cache=kv_cache)[0]
+                seqs = [torch.cat([seq, row]) for seq, row in zip(seqs, new)]
+                for i, seq in enumerate(seqs):
+                    torch.testing.assert_close(logits[i], gpt(seq[None])[0][0, -step:])
+            # memory follows the stored tokens: 8, 14 and 10 positions take 2, 4 and 3 blocks of 4
+            self.assertEqual([len(kv_cache.block_tables[i]) for i in range(3)], [2, 4, 3])
+            self.assertEqual(kv_cache.nbytes(), 9 * pool.block_nbytes())
+            self.assertEqual(pool.block_nbytes(), 4 * gpt.kv_cache_bytes_per_token())
+            # finished sequences hand their blocks back for reuse
+            freed = kv_cache.block_tables[1]
+            kv_cache.free_sequence(1)
+            self.assertEqual(len(pool.free), 16 - 5)
+            kv_cache.add_sequence(3)
+            kv_cache.set_batch([3, 0])
+            seq = torch.randint(0, 11, (1, 6))
+            logits = gpt(torch.cat([seq, torch.randint(0, 11, (1, 6))]), kv_cache=kv_cache)[0]
+            self.assertTrue(set(kv_cache.block_tables[3]) <= set(freed))
+            torch.testing.assert_close(logits[0], gpt(seq)[0][0])
+
+    @weight(1)
+    def test_21_engine(self):
+        """[T21] Test the continuous-batching engine against generate"""
+        from mingpt import model
+        from mingpt.engine import Engine
+        torch.manual_seed(3407)
+        C = model.GPT.get_default_config()
+        C.block_size = 32
+        C.vocab_size = 11
+        C.n_layer = 2
+        C.n_query_head = 4
+        C.n_kv_head = 2
+        C.n_embd = 16
+        C.rope = True
+        gpt = model.GPT(C).eval()
+        E = Engine.get_default_config()
+        E.max_batch_size = 3
+        E.block_len = 4
+        E.n_blocks = 12 # too few for every request at once, so admission has to wait for blocks
+        E.stop_token = 7
+        engine = Engine(E, gpt)
+        requests = [(torch.randint(0, 11, (n,)).tolist(), m) for n, m in [(3, 9), (9, 4), (5, 12), (2, 30), (12, 1), (30, 5)]]
+        ids = [engine.add_request(prompt, max_new_tokens) for prompt, max_new_tokens in requests]
+        with self.assertRaises(AssertionError):
+            engine.add_request([1, 2], 0) # would outgrow the single block it reserves
+        finished = engine.run()
+        self.assertEqual(sorted(finished), ids)
+        self.assertEqual((len(engine.running), engine.reserved_blocks, len(engine.pool.free)), (0, 0, 12))
+        for request_id, (prompt, max_new_tokens) in zip(ids, requests):
+            y, _ = gpt.generate(torch.tensor([prompt]), max_new_tokens, use_cache=True)
+            expected = y[0].tolist()[:C.block_size + 1]
+            if 7 in expected[len(prompt):]:
+                expected = expected[:expected.index(7, len(prompt)) + 1]
+            self.assertEqual(finished[request_id], expected)
+
+    @weight(1)
+    def test_22_ragged_batches(self):
+        """[T22] Test left-padded batches of prompts with different lengths"""
+        from mingpt import model
+        for rope, n_kv_head, attn_impl, window_size in [(True, 4, 'einsum', None), (True, 2, 'sdpa', None),
+                                                        (False, 2, 'tiled', None), (True, 1, 'einsum', 4)]:
+            torch.manual_seed(3407)
+            C = model.GPT.get_default_config()
+            C.block_size = 24
+            C.vocab_size = 11
+            C.n_layer = 2
+            C.n_query_head = 4
+            C.n_kv_head = n_kv_head
+            C.n_embd = 16
+            C.rope = rope
+            C.attn_impl = attn_impl
+            C.window_size = window_size
+            gpt = model.GPT(C).eval()
+            prompts = [torch.randint(0, 11, (n,)) for n in [3, 9, 6]]
+            idx, attention_mask = model.pad_prompts(prompts, pad_token=5)
+            self.assertEqual(attention_mask.sum(dim=1).tolist(), [3, 9, 6])
+            logits = gpt(idx, attention_mask=attention_mask)[0]
+            for row, prompt in enumerate(prompts):
+                torch.testing.assert_close(logits[row, -len(prompt):], gpt(prompt[None])[0][0])
+            # greedy continuations match generating every prompt on its own, cached or not, for as long as
+            # the padded batch fits in block_size (it is cropped as a whole after that)
+            n = C.block_size - idx.size(1) + 1
+            for use_cache in [False, True]:
+                y, _ = gpt.generate(idx, 20, use_cache=use_cache, attention_mask=attention_mask)
+                self.assertEqual(y.size(1), idx.size(1) + 20)
+                for row, prompt in enumerate(prompts):
+                    expected, _ = gpt.generate(prompt[None], 20, use_cache=use_cache)
+                    self.assertEqual(y[row, -20:][:n].tolist(), expected[0, -20:][:n].tolist())
+
+    @weight(1)
+    def test_23_speculative_decoding(self):
+        """[T23] Test speculative decoding with a draft model"""
+        from mingpt import model
+        def build(n_layer, seed):
+            torch.manual_seed(seed)
+            C = model.GPT.get_default_config()
+            C.block_size = 24
+            C.vocab_size = 5
+            C.n_layer = n_layer
+            C.n_query_head = 4
+            C.n_kv_head = 2
+            C.n_embd = 16
+            C.rope = True
+            return model.GPT(C).eval()
+        gpt, draft = build(3, 3407), build(1, 0)
+        idx = torch.randint(0, 5, (3, 4))
+        # greedy decoding gives exactly the target's tokens, also past the point where rounds no longer fit
+        expected, _ = gpt.generate(idx, 20, use_cache=True)
+        for n_draft in [1, 3, 4]:
+            y, _ = gpt.generate(idx, 20, draft_model=draft, n_draft=n_draft)
+            self.assertEqual(y.tolist(), expected.tolist())
+        y, _ = gpt.generate(idx, 20, draft_model=gpt)
+        self.assertEqual(y.tolist(), expected.tolist())
+        # sampled tokens follow the target's distribution: exactly known for the first, estimated for the third
+        torch.manual_seed(0)
+        n = 4000
+        idx = torch.full((n, 1), 2, dtype=torch.long)
+        y, _ = gpt.generate(idx, 3, do_sample=True, draft_model=draft, n_draft=2)
+        ref, _ = gpt.generate(idx, 3, do_sample=True, use_cache=True)
+        probs = torch.softmax(gpt(idx[:1])[0][0, -1], dim=-1)
+        freq = torch.bincount(y[:, 1], minlength=5).float() / n
+        self.assertLess((freq - probs).abs().max().item(), 0.04)
+        freq_ref = torch.bincount(ref[:, 3], minlength=5).float() / n
+        freq = torch.bincount(y[:, 3], minlength=5).float() / n
+        self.assertLess((freq - freq_ref).abs().max().item(), 0.05)
+
+    @weight(1)
+    def test_24_shared_prefix_sampling(self):
+        """[T24] Test shared-prefix KV reuse for num_samples and beam search"""
+        from mingpt import model
+        torch.manual_seed(3407)
+        C = model.GPT.get_default_config()
+        C.block_size = 40
+        C.vocab_size = 7
+        C.n_layer = 2
+        C.n_query_head = 4
+        C.n_kv_head = 2
+        C.n_embd = 16
+        C.rope = True
+        gpt = model.GPT(C).eval()
+        # forked sequences share their blocks and copy the last one on write
+        pool = model.KVBlockPool(gpt.n_kv_layers, 6, block_len=4)
+        cache = model.PagedKVCache(pool)
+        cache.add_sequence(0)
+        cache.set_batch([0])
+        prompt = torch.randint(0, 7, (1, 6))
+        gpt(prompt, kv_cache=cache)
+        cache.fork_sequence(0, 1)
+        cache.fork_sequence(0, 2)
+        self.assertEqual(cache.nbytes(), 2 * pool.block_nbytes())
+        self.assertEqual([pool.refs[block] for block in cache.block_tables[2]], [3, 3])
+        cache.set_batch([0, 1, 2])
+        logits = gpt(torch.tensor([[1], [1], [4]]), kv_cache=cache)[0]
+        torch.testing.assert_close(logits[0], logits[1])
+        torch.testing.assert_close(logits[2, -1], gpt(torch.cat((prompt, torch.tensor([[4]])), dim=1))[0][0, -1])
+        self.assertEqual(len(set(cache.block_tables[0][1:] + cache.block_tables[1][1:] + cache.block_tables[2][1:])), 3)
+        self.assertEqual(cache.block_tables[0][0], cache.block_tables[2][0])
+        for seq_id in [0, 1, 2]:
+            cache.free_sequence(seq_id)
+        self.assertEqual(sorted(pool.free), list(range(6)))
+        self.assertEqual(pool.refs, [0] * 6)
+
+        # greedy samples equal the single greedy completion, also when they outgrow block_size
+        prompts = [torch.randint(0, 7, (n,)) for n in [5, 11]]
+        idx, attention_mask = model.pad_prompts(prompts)
+        for max_new_tokens in [10, 40]:
+            y, _ = gpt.generate(idx, max_new_tokens, use_cache=True, attention_mask=attention_mask, num_samples=3)
+            expected, _ = gpt.generate(idx, max_new_tokens, use_cache=True, attention_mask=attention_mask)
+            self.assertEqual(y.tolist(), expected.repeat_interleave(3, dim=0).tolist())
+        torch.manual_seed(0)
+        y, _ = gpt.generate(idx[1:], 10, do_sample=True, use_cache=True, num_samples=50)
+        self.assertEqual(y.shape, (50, 21))
+        self.assertGreater(len(set(map(tuple, y.tolist()))), 1)
+
+        # one beam is greedy decoding; more beams find sequences at least as likely, scored exactly
+        def score(seq, n_prompt):
+            logprobs = torch.log_softmax(gpt(seq[None, :-1])[0][0], dim=-1)
+            return logprobs[n_prompt - 1:].gather(1, seq[n_prompt:, None]).sum()
+        prompt = idx[1:]
+        beams, scores = gpt.beam_search(prompt, 12, num_beams=1)
+        self.assertEqual(beams[:, 0].tolist(), gpt.generate(prompt, 12)[0].tolist())
+        greedy_score = scores[0, 0]
+        beams, scores = gpt.beam_search(prompt, 12, num_beams=4)
+        self.assertEqual(beams.shape, (1, 4, 23))
+        self.assertGreaterEqual(scores[0, 0].item(), greedy_score.item() - 1e-5)
+        self.assertTrue(torch.all(scores[0, :-1] >= scores[0, 1:]))
+        for beam, beam_score in zip(beams[0], scores[0]):
+            torch.testing.assert_close(score(beam, 11), beam_score, atol=1e-4, rtol=1e-4)
+        # left-padded prompts get the beams of their unpadded selves
+        beams, scores = gpt.beam_search(idx, 12, num_beams=4, attention_mask=attention_mask)
+        for row, prompt in enumerate(prompts):
+            expected, expected_scores = gpt.beam_search(prompt[None], 12, num_beams=4)
+            self.assertEqual(beams[row, :, -12:].tolist(), expected[0, :, -12:].tolist())
+            torch.testing.assert_close(scores[row], expected_scores[0], atol=1e-4, rtol=1e-4)
+
+    @weight(1)
+    def test_25_prefix_cache(self):
+        """[T25] Test the radix-tree prefix cache across generate calls"""
+        from mingpt import model
+        torch.manual_seed(3407)
+        C = model.GPT.get_default_config()
+        C.block_size = 32
+        C.vocab_size = 9
+        C.n_layer = 3
+        C.n_query_head = 4
+        C.n_kv_head = 2
+        C.n_embd = 16
+        C.rope = True
+        C.kv_share = 2
+        gpt = model.GPT(C).eval()
+        header = torch.randint(0, 9, (1, 12))
+        prompts = [torch.cat((header, torch.randint(0, 9, (1, n))), dim=1) for n in [3, 5, 4]]
+        cache = model.PrefixCache()
+        for prompt in prompts + prompts[:1]:
+            y, _ = gpt.generate(prompt, 10, use_cache=True, prefix_cache=cache)
+            expected, _ = gpt.generate(prompt, 10, use_cache=True)
+            self.assertEqual(y.tolist(), expected.tolist())
+        # the header is shared: one edge for it, one per distinct ending
+        self.assertEqual(len(cache.root.children), 1)
+        (node,) = cache.root.children.values()
+        self.assertEqual(node.tokens, tuple(header[0].tolist()))
+        self.assertEqual(len(node.children), 3)
+        bytes_per_token = gpt.kv_cache_bytes_per_token()
+        self.assertEqual(cache.nbytes, (12 + 3 + 5 + 4) * bytes_per_token)
+        stats = cache.stats()
+        self.assertEqual((stats['lookups'], stats['hits']), (4, 3))
+        self.assertEqual(stats['tokens_saved'], 12 + 12 + 14)
+        self.assertEqual(stats['bytes_saved'], stats['tokens_saved'] * bytes_per_token)
+        self.assertAlmostEqual(cache.hit_rate(), 38 / (15 + 17 + 16 + 15))
+        # batched prompts load the prefix they all share
+        idx = torch.cat((prompts[1][:, :16], prompts[2][:, :16]))
+        y, _ = gpt.generate(idx, 5, use_cache=True, prefix_cache=cache)
+        self.assertEqual(y.tolist(), gpt.generate(idx, 5, use_cache=True)[0].tolist())
+        self.assertEqual(cache.stats()['tokens_saved'], 38 + 2 * 15)
+        # over budget, the least recently used endings go first and the shared header last
+        cache.max_bytes = 22 * bytes_per_token
+        cache._evict()
+        self.assertEqual(cache.nbytes, (12 + 5 + 4) * bytes_per_token)
+        self.assertEqual(sorted(node.children), sorted([prompts[1][0, 12].item(), prompts[2][0, 12].item()]))
+        cache.max_bytes = 0
+        cache._evict()
+        self.assertEqual((cache.nbytes, cache.root.children), (0, {}))
+
+    @weight(1)
+    def test_26_partial_logits(self):
+        """[T26] Test projecting only the last positions onto the vocabulary"""
+        from mingpt import model
+        torch.manual_seed(3407)
+        C = model.GPT.get_default_config()
+        C.block_size = 16
+        C.vocab_size = 50
+        C.n_layer = 2
+        C.n_query_head = 4
+        C.n_kv_head = 2
+        C.n_embd = 16
+        C.rope = True
+        gpt = model.GPT(C).eval()
+        idx = torch.randint(0, 50, (3, 10))
+        logits = gpt(idx)[0]
+        for n_logits in [1, 4, 10]:
+            partial = gpt(idx, n_logits=n_logits)[0]
+            self.assertEqual(partial.shape, (3, n_logits, 50))
+            torch.testing.assert_close(partial, logits[:, -n_logits:])
+        with self.assertRaises(AssertionError):
+            gpt(idx, targets=idx, n_logits=1)
+        # decoding is unchanged, with and without the cache
+        for use_cache in [False, True]:
+            y, _ = gpt.generate(idx, 12, use_cache=use_cache)
+            x = idx
+            for _ in range(12):
+                x = torch.cat((x, gpt(x[:, -16:])[0][:, -1:].argmax(dim=-1)), dim=1)
+            self.assertEqual(y.tolist(), x.tolist())
+
+    @weight(1)
+    def test_27_chunked_cross_entropy(self):
+        """[T27] Test the chunked cross-entropy loss against F.cross_entropy"""
+        from mingpt import model
+        C = model.GPT.get_default_config()
+        C.block_size = 12
+        C.vocab_size = 37
+        C.n_layer = 2
+        C.n_query_head = 4
+        C.n_kv_head = 2
+        C.n_embd = 16
+        C.rope = True
+        C.embd_pdrop = C.resid_pdrop = C.attn_pdrop = 0.0
+        torch.manual_seed(3407)
+        gpt = model.GPT(C)
+        idx = torch.randint(0, 37, (4, 12))
+        targets = torch.randint(0, 37, (4, 12))
+        targets[0, :5] = -1 # ignored positions
+        logits, expected, _, _ = gpt(idx, targets)
+        expected.backward()
+        expected_grads = {name: p.grad.clone() for name, p in gpt.named_parameters()}
+        for chunk_size in [1, 7, 48, 1000]:
+            gpt.ce_chunk_size = chunk_size
+            gpt.zero_grad()
+            logits, loss, _, _ = gpt(idx, targets)
+            self.assertIsNone(logits)
+            torch.testing.assert_close(loss, expected)
+            loss.backward()
+            for name, p in gpt.named_parameters():
+                torch.testing.assert_close(p.grad, expected_grads[name], msg=name)
+        # logits are still there for inference
+        self.assertEqual(gpt(idx)[0].shape, (4, 12, 37))
+        # the function on its own, with gradients checked in double precision
+        x = torch.randn(9, 5, dtype=torch.double, requires_grad=True)
+        w = torch.randn(11, 5, dtype=torch.double, requires_grad=True)
+        t = torch.tensor([3, -1, 0, 10, 4, 4, -1, 7, 1])
+        self.assertTrue(torch.autograd.gradcheck(lambda x, w: model._chunked_cross_entropy(x, w, t, -1, 4), (x, w)))
+
+    @weight(1)
+    def test_28_sampling(self):
+        """[T28] Test batched greedy, top-k, top-p and per-row sampling"""
+        from mingpt import model, sampling
+        from mingpt.engine import Engine
+        torch.manual_seed(3407)
+        logits = torch.randn(4, 30)
+        self.assertEqual(sampling.sample_logits(logits).view(-1).tolist(), logits.argmax(dim=-1).tolist())
+        self.assertEqual(sampling.sample_logits(logits, do_sample=True, top_k=1).view(-1).tolist(), logits.argmax(dim=-1).tolist())
+        # top-k keeps the k largest logits, top-p the most likely tokens until their mass reaches p
+        probs = sampling.sampling_probs(logits, 0.5, do_sample=True, top_k=5)
+        v, i = torch.topk(logits, 5)
+        torch.testing.assert_close(probs, torch.zeros_like(logits).scatter(1, i, torch.softmax(v / 0.5, dim=-1)))
+        nucleus = torch.tensor([[0.5, 0.3, 0.15, 0.05]]).log()
+        torch.testing.assert_close(sampling.sampling_probs(nucleus, do_sample=True, top_p=0.7), torch.tensor([[0.625, 0.375, 0, 0]]))
+        torch.testing.assert_close(sampling.sampling_probs(nucleus, do_sample=True, top_p=0.5), torch.tensor([[1.0, 0, 0, 0]]))
+        # per-row settings give each row what it would get on its own
+        settings = dict(temperature=[0, 1.0, 2.0, 0.7], top_k=[0, 3, 0, 8], top_p=[1.0, 1.0, 0.6, 0.9])
+        probs = sampling.sampling_probs(logits, do_sample=True, **settings)
+        for row in range(4):
+            temperature, top_k, top_p = (settings[name][row] for name in ['temperature', 'top_k', 'top_p'])
+            expected = sampling.sampling_probs(logits[row:row+1], temperature, do_sample=True, top_k=top_k, top_p=top_p)
+            torch.testing.assert_close(probs[row:row+1], expected)
+        torch.testing.assert_close(probs[0], torch.nn.functional.one_hot(logits[0].argmax(), 30).float())
+        # per-row settings that filter nothing take the unfiltered path, without a full-vocabulary topk
+        from unittest import mock
+        with mock.patch.object(sampling.torch, 'topk', wraps=torch.topk) as topk:
+            sampling.sample_logits(logits, do_sample=True, temperature=[1.0, 0.5, 0, 2.0], top_k=[0, 0, 30, 0],
+                                   top_p=[1.0] * 4)
+            self.assertEqual(topk.call_count, 0)
+            sampling.sample_logits(logits, do_sample=True, top_k=[0, 4, 0, 2], top_p=[1.0] * 4)
+            self.assertEqual([call.args[1] for call in topk.call_args_list], [4])
+        mixed = dict(temperature=[1.0, 0.5, 1.0, 2.0], top_k=[0, 4, 0, 2])
+        mixed_probs = sampling.sampling_probs(logits, do_sample=True, **mixed)
+        for row in range(4):
+            expected = sampling.sampling_probs(logits[row:row+1], mixed['temperature'][row], do_sample=True,
+                                               top_k=mixed['top_k'][row] or None)
+            torch.testing.assert_close(mixed_probs[row:row+1], expected)
+        # and sample_logits draws from exactly these distributions
+        n = 20000
+        rows = torch.arange(4).repeat(n)
+        idx_next = sampling.sample_logits(logits[rows], do_sample=True, **{name: torch.tensor(value)[rows]
+                                                                           for name, value in settings.items()})
+        freq = torch.zeros(4, 30).index_put_((rows, idx_next.view(-1)), torch.ones(4 * n), accumulate=True) / n
+        self.assertLess((freq - probs).abs().max().item(), 0.02)
+
+        # the engine samples every request with its own settings in one batch
+        C = model.GPT.get_default_config()
+        C.block_size = 32
+        C.vocab_size = 11
+        C.n_layer = 2
+        C.n_query_head = 4
+        C.n_kv_head = 2
+        C.n_embd = 16
+        C.rope = True
+        gpt = model.GPT(C).eval()
+        E = Engine.get_default_config()
+        E.do_sample = True
+        E.top_p = 0.9
+        engine = Engine(E, gpt)
+        prompts = [torch.randint(0, 11, (n,)).tolist() for n in [3, 7, 5]]
+        greedy_id = engine.add_request(prompts[0], 10, temperature=0)
+        engine.add_request(prompts[1], 10, top_k=1)
+        engine.add_request(prompts[2], 10, temperature=1.5, top_k=4, top_p=1.0)
+        finished = engine.run()
+        for request_id in [greedy_id, greedy_id + 1]:
+            prompt = prompts[request_id - greedy_id]
+            self.assertEqual(finished[request_id], gpt.generate(torch.tensor([prompt]), 10, use_cache=True)[0][0].tolist())
+
 if __name__ == '__main__':
     unittest.main(buffer=False)